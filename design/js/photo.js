@@ -3,20 +3,165 @@ const ESCAPE = 27;
 const LEFT_ARROW = 37;
 const RIGHT_ARROW = 39;
 
+// Number of images to load ahead of the direction we're browsing in,
+// and behind it.
+const PREFETCH_AHEAD = 3;
+const PREFETCH_BEHIND = 1;
+
 // Bind navigation elementts. Back is for back to album.
 const back = document.getElementById("back");
 const prev = document.getElementById("prev");
 const next = document.getElementById("next");
 
+const photo = document.getElementById("photo");
+const download = document.getElementById("download");
+const navLeft = document.querySelector(".nav.left");
+const navRight = document.querySelector(".nav.right");
+
+// The URL of this page is /<album>/<image id>.
+const [albumName, imageId] = location.pathname.split("/").filter((part) => part);
+
+// Until the album manifest is loaded, and when it can't be loaded, all
+// navigation goes through the links to the other pages. With the
+// manifest, we swap the image in place instead.
+let manifest = null;
+
+// The image that is shown, and the one we're loading to show next.
+let current = -1;
+let wanted = -1;
+let direction = 1;
+
+// Image URL -> Promise of the image, once it is decoded.
+const loaded = new Map();
+
+const imageUrl = (i) => `${manifest.base}/${manifest.images[i].display}`;
+const pageUrl = (i) => `/${albumName}/${manifest.images[i].id}`;
+const inAlbum = (i) => i >= 0 && i < manifest.images.length;
+
+// Int -> Promise Image
+// Decoding before showing the image prevents a flash of a half drawn image.
+const load = (i) => {
+  const url = imageUrl(i);
+  if (!loaded.has(url)) {
+    const img = new Image();
+    img.src = url;
+    const decoded = img.decode ? img.decode() : Promise.resolve();
+    // Show the image anyway when decoding fails, the browser will
+    // show what it can.
+    loaded.set(url, decoded.then(() => img, () => img));
+  }
+  return loaded.get(url);
+};
+
+// Load the images around the current one, mostly in the direction we're
+// browsing in. Images outside of that window are forgotten, so memory
+// does not grow while browsing through a big album.
+const prefetch = () => {
+  const keep = new Set();
+  for (let offset = -PREFETCH_BEHIND; offset <= PREFETCH_AHEAD; offset++) {
+    const i = current + offset * direction;
+    if (inAlbum(i)) {
+      load(i);
+      keep.add(imageUrl(i));
+    }
+  }
+
+  for (const url of Array.from(loaded.keys())) {
+    if (!keep.has(url)) { loaded.delete(url); }
+  }
+};
+
+const setNav = (nav, i, title, symbol) => {
+  const link = nav.querySelector("a");
+  if (inAlbum(i)) {
+    nav.classList.remove("disabled");
+    link.href = pageUrl(i);
+    link.title = title;
+    link.innerHTML = symbol;
+  } else {
+    nav.classList.add("disabled");
+    link.removeAttribute("href");
+    link.removeAttribute("title");
+    link.innerHTML = "";
+  }
+};
+
+const render = (i) => {
+  current = i;
+  wanted = i;
+
+  const image = manifest.images[i];
+  photo.src = imageUrl(i);
+  download.href = `${manifest.base}/${image.original}`;
+  document.title = `${manifest.name} - ${i} / ${manifest.images.length - 1}`;
+
+  setNav(navLeft, i - 1, "Previous", "&#10094;");
+  setNav(navRight, i + 1, "Next", "&#10095;");
+  prefetch();
+};
+
+// Int -> ()
+// Move through the album. When moving again before the image is loaded,
+// we skip the image that was still loading.
+const step = (delta) => {
+  const i = wanted + delta;
+  if (!inAlbum(i)) { return; }
+
+  wanted = i;
+  direction = delta < 0 ? -1 : 1;
+  load(i).then(() => {
+    if (wanted !== i) { return; }
+    render(i);
+    history.pushState({ index: i }, "", pageUrl(i));
+  });
+};
+
+const enhance = (albumManifest) => {
+  const index = albumManifest.images.findIndex((image) => image.id === imageId);
+  if (index < 0 || photo == null || download == null) { return; }
+
+  manifest = albumManifest;
+  current = index;
+  wanted = index;
+  history.replaceState({ index: index }, "");
+  prefetch();
+
+  // Plain clicks on the arrows move in place. Clicks with a modifier,
+  // like opening the page in a new tab, still follow the link.
+  [[navLeft, -1], [navRight, 1]].forEach(([nav, delta]) => {
+    nav.addEventListener("click", (ev) => {
+      if (ev.button !== 0 || ev.ctrlKey || ev.metaKey || ev.shiftKey) { return; }
+      ev.preventDefault();
+      step(delta);
+    });
+  });
+
+  window.addEventListener("popstate", (ev) => {
+    if (ev.state != null && inAlbum(ev.state.index)) {
+      direction = ev.state.index < current ? -1 : 1;
+      render(ev.state.index);
+    }
+  });
+};
+
+if (albumName != null && imageId != null && window.fetch != null) {
+  fetch(`/${albumName}/manifest.json`)
+    .then((response) => response.ok ? response.json() : Promise.reject())
+    .then(enhance)
+    .catch(() => {});
+}
+
 // KeyPress -> Maybe ClickEvent
 document.onkeyup = (ev) => {
   switch(ev.keyCode)
   {
     case LEFT_ARROW:
-      if (prev != null) { prev.click(); }
+      if (manifest != null) { step(-1); }
+      else if (prev != null) { prev.click(); }
       break;
     case RIGHT_ARROW:
-      if (next != null) { next.click(); }
+      if (manifest != null) { step(1); }
+      else if (next != null) { next.click(); }
       break;
     case ESCAPE:
       if (back != null) { back.click(); }
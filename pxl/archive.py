@@ -0,0 +1,155 @@
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, List
+
+# Archives get the same timestamp for every file, so that the same files
+# give the same bytes. Zip can't go before 1980.
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ARCHIVE_MTIME = 315532800
+
+
+class Output(ABC):
+    """
+    Where files go, by their path relative to the root: a directory or
+    an archive.
+    """
+
+    @abstractmethod
+    def write_bytes(self, name: str, data: bytes) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    def sync(self) -> None:
+        # Make sure the files written so far are on disk.
+        pass
+
+    def write_text(self, name: str, text: str) -> None:
+        self.write_bytes(name, text.encode("utf-8"))
+
+    def copy_tree(self, src_dir: Path, name: str) -> None:
+        # Sorted, so that archives list the files in the same order.
+        for path in sorted(src_dir.rglob("*")):
+            if path.is_file():
+                relative = path.relative_to(src_dir).as_posix()
+                self.write_bytes(f"{name}/{relative}", path.read_bytes())
+
+
+class DirectoryOutput(Output):
+    def __init__(self, dir_path: Path, clear: bool = True) -> None:
+        self.dir_path = dir_path
+        # Files that were written since the last `sync`.
+        self.unsynced: List[Path] = []
+        if clear:
+            clear_directory(dir_path)
+        dir_path.mkdir(parents=True, exist_ok=True)
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        path = self.dir_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        self.unsynced.append(path)
+
+    def sync(self) -> None:
+        for path in self.unsynced:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced = []
+
+    def copy_tree(self, src_dir: Path, name: str) -> None:
+        shutil.copytree(src_dir, self.dir_path / name)
+
+
+class TarOutput(Output):
+    def __init__(self, stream: BinaryIO) -> None:
+        # Stream mode never seeks, so we can write to a pipe. Otherwise
+        # the archive starts where the stream is, which lets `export.py`
+        # continue an archive that was cut after its last complete file.
+        self.stream = stream
+        mode = "w" if stream.seekable() else "w|"
+        self.tar = tarfile.open(fileobj=stream, mode=mode, format=tarfile.PAX_FORMAT)
+
+    @property
+    def offset(self) -> int:
+        # Where the archive ends, after the last complete file.
+        offset: int = self.tar.offset
+        return offset
+
+    def sync(self) -> None:
+        self.stream.flush()
+        # A pipe can't be synced, and nothing resumes an archive on one.
+        if self.stream.seekable():
+            os.fsync(self.stream.fileno())
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = ARCHIVE_MTIME
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self) -> None:
+        self.tar.close()
+
+
+class ZipOutput(Output):
+    def __init__(self, stream: BinaryIO, compress: bool = True) -> None:
+        self.zip = zipfile.ZipFile(stream, mode="w")
+        self.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        info = zipfile.ZipInfo(name, date_time=ARCHIVE_DATE_TIME)
+        info.compress_type = self.compress_type
+        # Unix permissions, the same on every platform.
+        info.create_system = 3
+        info.external_attr = 0o644 << 16
+        self.zip.writestr(info, data)
+
+    def close(self) -> None:
+        self.zip.close()
+
+
+@contextmanager
+def writer(
+    output_format: str, stream: BinaryIO, compress: bool = True
+) -> Iterator[Output]:
+    """
+    Write a "tar" or "zip" archive to a binary stream. Files that are
+    compressed already, like JPEGs, are stored without `compress`.
+    """
+    output: Output
+    if output_format == "tar":
+        output = TarOutput(stream)
+    else:
+        output = ZipOutput(stream, compress)
+    yield output
+    output.close()
+
+
+def clear_directory(dir_path: Path) -> None:
+    """Remove all directory contents, except for the directory itself.
+
+    This is useful so the inode number for the directory doesn't get removed
+    and HTTP servers and the like keep on working."""
+
+    if not dir_path.exists():
+        return
+
+    assert dir_path.is_dir()
+
+    for entry in dir_path.iterdir():
+        if entry.is_dir():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
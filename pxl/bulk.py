@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import datetime
+import re
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import pxl.exif as exif
+import pxl.state as state
+import pxl.watch as watch
+
+# Archive folders are usually named like "2019-03-23 Spring drinks", or
+# "20190323_spring_drinks". Separators between the parts are optional.
+FOLDER_DATE = re.compile(
+    r"^(?P<year>\d{4})[-_. ]?(?P<month>\d{2})[-_. ]?(?P<day>\d{2})(?:[-_. ]+(?P<rest>.*))?$"
+)
+
+
+@dataclass
+class AlbumPlan:
+    name_display: str
+    created: datetime.datetime
+    files: List[Path]
+    headers: Dict[Path, exif.Header]
+    # Whether the images are added to an album that is already in the state.
+    existing: bool
+
+    def to_album(self, overview: state.Overview) -> state.Album:
+        album = overview.get_album_by_name(self.name_display)
+        if album:
+            return album
+
+        return state.Album(
+            name_display=self.name_display,
+            name_nav=self.name_display.lower().replace(" ", "-"),
+            created=self.created,
+            images=[],
+        )
+
+
+def plan_import(root: Path, overview: state.Overview) -> List[AlbumPlan]:
+    """
+    Map every subdirectory of `root` with JPEG files to an album.
+
+    The album name and date are taken from the directory name when it
+    starts with a date. Otherwise the directory name is the album name,
+    and the date is the earliest capture time of its images. Directories
+    with the same name but different dates, like a yearly event, become
+    different albums, see `album_name`. Directories that map to the same
+    album are merged. The images of every album are ordered by capture
+    time.
+    """
+    dirs = {
+        dir_path: [
+            entry for entry in sorted(dir_path.iterdir()) if watch.is_jpeg(entry)
+        ]
+        for dir_path in sorted(root.iterdir())
+        if dir_path.is_dir()
+    }
+    headers = exif.scan([entry for files in dirs.values() for entry in files])
+
+    folders = [
+        (dir_path, files, *parse_folder_name(dir_path.name))
+        for dir_path, files in dirs.items()
+        if files
+    ]
+    dates: Dict[str, Set[Optional[datetime.date]]] = {}
+    for _, _, folder_name, folder_date in folders:
+        dates.setdefault(folder_name, set()).add(
+            folder_date.date() if folder_date else None
+        )
+
+    plans: Dict[str, AlbumPlan] = {}
+    for dir_path, files, folder_name, folder_date in folders:
+        name_display = album_name(
+            folder_name, folder_date, dates[folder_name], overview
+        )
+        created = folder_date or guess_created(
+            dir_path, [headers[entry] for entry in files]
+        )
+
+        if name_display in plans:
+            plans[name_display].files.extend(files)
+        else:
+            album = overview.get_album_by_name(name_display)
+            plans[name_display] = AlbumPlan(
+                name_display=name_display,
+                created=album.created if album else created,
+                files=files,
+                headers=headers,
+                existing=album is not None,
+            )
+
+    for plan in plans.values():
+        plan.files.sort(key=lambda entry: exif.capture_order(entry, headers[entry]))
+
+    return list(plans.values())
+
+
+def parse_folder_name(folder_name: str) -> Tuple[str, Optional[datetime.datetime]]:
+    match = FOLDER_DATE.match(folder_name)
+    if not match:
+        return folder_name.title(), None
+
+    try:
+        created = datetime.datetime(
+            int(match["year"]), int(match["month"]), int(match["day"])
+        )
+    except ValueError:
+        # Not a date after all, e.g. "1000 lakes".
+        return folder_name.title(), None
+
+    rest = (match["rest"] or "").replace("_", " ").strip()
+    return (rest or folder_name).title(), created
+
+
+def album_name(
+    folder_name: str,
+    folder_date: Optional[datetime.datetime],
+    dates: Set[Optional[datetime.date]],
+    overview: state.Overview,
+) -> str:
+    """
+    The name of the album for a directory, given the `dates` of all
+    directories with the same name.
+
+    A dated directory only gets the plain name when it is the only one
+    with that name, and an album with that name doesn't exist yet or is
+    from the same day. Otherwise the year is added, or the whole date
+    when another directory with that name is from the same year.
+    """
+    if folder_date is None:
+        return folder_name
+
+    date = folder_date.date()
+    candidates = [folder_name] if dates == {date} else []
+    years = [other.year for other in dates if other is not None]
+    if years.count(date.year) == 1:
+        candidates.append(f"{folder_name} {date.year}")
+    candidates.append(f"{folder_name} {date.isoformat()}")
+
+    for candidate in candidates:
+        album = overview.get_album_by_name(candidate)
+        if album is None or album.created.date() == date:
+            return candidate
+
+    return candidates[-1]
+
+
+def guess_created(dir_path: Path, headers: List[exif.Header]) -> datetime.datetime:
+    """
+    Use the earliest capture time of the images, or the modification
+    time of the directory when none of the images has one.
+    """
+    captured = [header.captured for header in headers if header.captured]
+    if captured:
+        return min(captured)
+
+    return datetime.datetime.fromtimestamp(dir_path.stat().st_mtime)
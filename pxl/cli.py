@@ -1,33 +1,55 @@
+from __future__ import annotations
+
 from __main__ import __file__ as entrypoint_file  # type: ignore
 import click
+import contextlib
 import datetime
-from dateutil import parser
 import functools
 import getpass
-import http.server
-import json
-import socketserver
-import subprocess
 import sys
 import copy
+import time
 
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, List, Optional, Any
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Any,
+    Set,
+    Tuple,
+)
 
 import pxl.config as config
-import pxl.generate as generate
 import pxl.state as state
-import pxl.upload as upload
+import pxl.watch as watch
+
+# Most of these modules pull in boto3, Pillow or Jinja, which take most of
+# the startup time. Commands import them when they run, so commands that
+# don't need them, and `--help`, start quickly.
+if TYPE_CHECKING:
+    import pxl.compress as compress
+    import pxl.dedupe as dedupe
+    import pxl.exif as exif
+    import pxl.journal as journal
+    import pxl.upload as upload
 
 entrypoint = Path(entrypoint_file).parent.absolute()
 if entrypoint.match("/usr/*"):
     build_path = Path.home() / ".local" / "share" / "pxl" / "build"
+    cache_path = Path.home() / ".cache" / "pxl"
 else:
     build_path = Path("ignore/build")
+    cache_path = Path("ignore/cache")
 
 
 def validate(value: str) -> Optional[Any]:
+    from dateutil import parser
+
     try:
         date: datetime.datetime = parser.parse(value)
     except:
@@ -40,6 +62,30 @@ def cli() -> None:
     """Photo management script for S3 albums."""
 
 
+def duplicate_options(command: Callable[..., None]) -> Callable[..., None]:
+    """Options for finding near-duplicates while uploading."""
+    command = click.option(
+        "--duplicates",
+        # The values of `dedupe.Mode`.
+        type=click.Choice(["report", "flag", "skip"]),
+        default="report",
+        help="What to do with near-duplicate images",
+    )(command)
+    command = click.option(
+        "--duplicate-distance",
+        default=6,
+        type=int,
+        help="Number of hash bits in which near-duplicates may differ",
+    )(command)
+    command = click.option(
+        "--duplicates-in-library",
+        is_flag=True,
+        type=bool,
+        help="Look for near-duplicates in all albums, not only the same album",
+    )(command)
+    return command
+
+
 @cli.command(name="init")
 @click.option("--force", is_flag=True, default=False)
 def init_cmd(force: bool) -> None:
@@ -95,12 +141,13 @@ def edit_cmd(album_name: str, force: bool) -> None:
     """
     Edit the name and date of an album
     """
+    import pxl.remote as remote
+    import pxl.upload as upload
+
     cfg = config.load()
     with upload.client(cfg, break_lock=force) as client:
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            pxl_state = state.Overview.from_json(pxl_state_json)
-            assert pxl_state is not None, "Expected state to be valid"
+            pxl_state = remote.load(client)
         except client.boto.exceptions.NoSuchKey as e:
             pxl_state = state.Overview.empty()
         except Exception as e:
@@ -132,27 +179,65 @@ def edit_cmd(album_name: str, force: bool) -> None:
                 alt_album.images = alt_album.images + old_album.images
                 pxl_state = pxl_state.remove_album(old_album)
                 pxl_state = pxl_state.edit_album(alt_album, alt_album)
-                upload.private_json(
-                    client, json.dumps(pxl_state.to_json()), "state.json"
-                )
+                remote.save(client, [alt_album], removed=[old_album])
             else:
                 new_album.name_display = album_name
                 new_album.name_nav = album_name.lower().replace(" ", "-")
                 new_album.created = album_date
 
                 pxl_state = pxl_state.edit_album(old_album, new_album)
-                upload.private_json(
-                    client, json.dumps(pxl_state.to_json()), "state.json"
-                )
+                remote.save(client, [new_album], removed=[old_album])
 
 
 @cli.command(name="upload")
 @click.argument("dir_name")
 @click.option("--force", is_flag=True, type=bool, help="Force break lock")
-def upload_cmd(dir_name: str, force: bool) -> None:
+@click.option(
+    "--watch",
+    "watch_dir",
+    is_flag=True,
+    type=bool,
+    help="Keep uploading new images until interrupted",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    type=bool,
+    help="Continue an upload of this directory that was interrupted",
+)
+@click.option(
+    "--commit-interval",
+    default=5.0,
+    type=float,
+    help="With --watch, save the state at least every this many seconds",
+)
+@click.option(
+    "--commit-every",
+    default=25,
+    type=int,
+    help="Save the state at least every this many images",
+)
+@duplicate_options
+def upload_cmd(
+    dir_name: str,
+    force: bool,
+    watch_dir: bool,
+    resume: bool,
+    commit_interval: float,
+    commit_every: int,
+    duplicates: str,
+    duplicate_distance: int,
+    duplicates_in_library: bool,
+) -> None:
     """
     Upload a directory to the photo hosting.
     """
+    import pxl.dedupe as dedupe
+    import pxl.exif as exif
+    import pxl.journal as journal
+    import pxl.remote as remote
+    import pxl.upload as upload
+
     cfg = config.load()
 
     dir_path = Path(dir_name)
@@ -160,19 +245,32 @@ def upload_cmd(dir_name: str, force: bool) -> None:
         click.echo(f"{dir_path} is not a directory.", err=True)
         sys.exit(1)
 
-    if not list(dir_path.glob("*.jpg")) and not list(dir_path.glob("*.JPG")) and not list(dir_path.glob("*.jpeg")):
+    # When watching, the directory may still be empty because the
+    # camera has yet to take its first picture.
+    files = [entry for entry in dir_path.iterdir() if watch.is_jpeg(entry)]
+    if not watch_dir and not files:
         click.echo(f"{dir_path} does not contain any .jp(e)g files.", err=True)
         sys.exit(1)
 
-    with upload.client(cfg, break_lock=force) as client:
-        album_name = click.prompt(
-            "What name should the album have?", default=dir_path.name.title()
-        )
+    # Reading only the headers is quick, even for a full memory card.
+    # Without the pixel data, we can order the images by capture time
+    # and suggest a date for the album before uploading anything.
+    headers = exif.scan(files)
+    files.sort(key=lambda entry: exif.capture_order(entry, headers[entry]))
+
+    upload_journal = journal.Journal.load(cfg, dir_path)
+    if resume and upload_journal is None:
+        click.echo(f"There is no unfinished upload of {dir_path}.", err=True)
+        sys.exit(1)
 
+    if not resume and upload_journal is not None:
+        click.echo(f"The last upload of {dir_path} did not finish.", err=True)
+        click.echo("Pass --resume to continue it.", err=True)
+        sys.exit(1)
+
+    with upload.client(cfg, break_lock=force) as client:
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            pxl_state = state.Overview.from_json(pxl_state_json)
-            assert pxl_state is not None, "Expected state to be valid"
+            pxl_state = remote.load(client)
         except client.boto.exceptions.NoSuchKey as e:
             pxl_state = state.Overview.empty()
         except Exception as e:
@@ -181,57 +279,784 @@ def upload_cmd(dir_name: str, force: bool) -> None:
 
         print(pxl_state)
 
-        # Get existing album with this name for appending.
-        album = pxl_state.get_album_by_name(album_name)
-        if album:
-            click.confirm("Album already exists. Add to existing album?", abort=True)
-        else:
-            date = click.prompt(  # type: ignore
-                "What date was the album created?",
-                default=datetime.datetime.now(),
-                value_proc=validate,
+        if upload_journal is not None:
+            # The album may not be in the state yet, when we crashed
+            # before saving the state for the first time.
+            album = (
+                pxl_state.get_album_by_name(upload_journal.album.name_display)
+                or upload_journal.album
             )
+            click.echo(f"Resuming upload to {album.name_display}.", err=True)
+        else:
+            album = prompt_album(dir_path, pxl_state, default_date(headers))
+            upload_journal = journal.Journal.create(cfg, dir_path, album)
+
+        detector = dedupe.Detector.from_overview(
+            pxl_state,
+            dedupe.Mode(duplicates),
+            duplicate_distance,
+            library=duplicates_in_library,
+            album_names=[album.name_display],
+        )
 
-            click.echo("Creating new album.", err=True)
-            album = state.Album(
-                name_display=album_name,
-                name_nav=album_name.lower().replace(" ", "-"),
-                created=date,
-                images=[],
+        if watch_dir:
+            watch_upload(
+                client,
+                dir_path,
+                pxl_state,
+                album,
+                upload_journal,
+                detector,
+                commit_interval,
+                commit_every,
             )
+            print_stats(client)
+            click.echo("Continue watching later with --resume.", err=True)
+            return
 
-        # Find all files with known JPEG extensions. We don't
-        # traverse nested directories, just the toplevel.
-        for entry in sorted(dir_path.iterdir()):
-            if not entry.is_file():
+        # We don't traverse nested directories, just the toplevel.
+        uncommitted: List[Path] = []
+        for entry in files:
+            if upload_journal.is_committed(entry, album):
                 continue
 
-            if not entry.suffix.lower() in [".jpeg", ".jpg"]:
+            check = functools.partial(
+                detector.check, entry, album_name=album.name_display
+            )
+            image = upload.public_image_with_size(
+                client, entry, upload_journal, check, headers[entry]
+            )
+            if image is None:
                 continue
 
-            image = upload.public_image_with_size(client, entry)
             album = album.add_image(image)
+            uncommitted.append(entry)
+
+            if len(uncommitted) >= commit_every:
+                pxl_state = commit_album(
+                    client, pxl_state, album, upload_journal, uncommitted
+                )
+                uncommitted = []
+
+        # With `--duplicates skip`, a new album may end up without images.
+        # Saving it would break `pxl build`.
+        if album.images:
+            commit_album(client, pxl_state, album, upload_journal, uncommitted)
+        else:
+            click.echo(f"{album.name_display} has no images, not saving it.", err=True)
+        upload_journal.remove()
+        print_stats(client)
+
+
+def prompt_album(
+    dir_path: Path, pxl_state: state.Overview, date_default: datetime.datetime
+) -> state.Album:
+    """Ask for the album to upload to, which may be a new one."""
+    album_name = click.prompt(
+        "What name should the album have?", default=dir_path.name.title()
+    )
+
+    # Get existing album with this name for appending.
+    album = pxl_state.get_album_by_name(album_name)
+    if album:
+        click.confirm("Album already exists. Add to existing album?", abort=True)
+        return album
+
+    date = click.prompt(  # type: ignore
+        "What date was the album created?",
+        default=date_default,
+        value_proc=validate,
+    )
+
+    click.echo("Creating new album.", err=True)
+    return state.Album(
+        name_display=album_name,
+        name_nav=album_name.lower().replace(" ", "-"),
+        created=date,
+        images=[],
+    )
+
+
+def print_stats(client: upload.Client) -> None:
+    """Show how the requests to the bucket went, per kind of request."""
+    for line in client.controller.summary():
+        click.echo(line, err=True)
+
+
+def default_date(headers: Dict[Path, exif.Header]) -> datetime.datetime:
+    """The earliest capture time of the images, or now when there is none."""
+    captured = [header.captured for header in headers.values() if header.captured]
+    return min(captured, default=datetime.datetime.now())
+
+
+def watch_upload(
+    client: upload.Client,
+    dir_path: Path,
+    pxl_state: state.Overview,
+    album: state.Album,
+    upload_journal: journal.Journal,
+    detector: dedupe.Detector,
+    commit_interval: float,
+    commit_every: int,
+) -> None:
+    """
+    Upload new images in a directory as soon as they are written.
+
+    The state is saved whenever `commit_every` images are not saved yet,
+    or when the oldest unsaved image is `commit_interval` seconds old.
+    Stop with Ctrl-C, which saves the remaining images.
+
+    An image that fails to upload is reported and skipped, so one broken
+    file doesn't stop the session. Uploading again with `--resume` tries
+    it again.
+    """
+    import pxl.upload as upload
+
+    click.echo(f"Watching {dir_path} for new images. Stop with Ctrl-C.", err=True)
+
+    # Images that are in the state already don't need to be uploaded
+    # again when we resume watching.
+    seen: Set[Path] = {
+        entry
+        for entry in dir_path.iterdir()
+        if upload_journal.is_committed(entry, album)
+    }
+    uncommitted: List[Path] = []
+    uncommitted_since = time.monotonic()
+
+    try:
+        for batch in watch.poll(dir_path, seen, interval=1.0):
+            for entry in batch:
+                check = functools.partial(
+                    detector.check, entry, album_name=album.name_display
+                )
+                try:
+                    image = upload.public_image_with_size(
+                        client, entry, upload_journal, check
+                    )
+                except Exception as e:
+                    click.echo(f"Skipping {entry}, it failed: {e}", err=True)
+                    continue
+                if image is None:
+                    continue
+
+                album = album.add_image(image)
+                if not uncommitted:
+                    uncommitted_since = time.monotonic()
+                uncommitted.append(entry)
+
+            if not uncommitted:
+                continue
+
+            age = time.monotonic() - uncommitted_since
+            if len(uncommitted) >= commit_every or age >= commit_interval:
+                pxl_state = commit_album(
+                    client, pxl_state, album, upload_journal, uncommitted
+                )
+                uncommitted = []
+
+    except KeyboardInterrupt:
+        click.echo("Stopped watching.", err=True)
+
+    finally:
+        # Also when something else failed, save the images that are done.
+        # Without any, there is nothing to save, and a new album would
+        # be saved without images.
+        if uncommitted:
+            commit_album(client, pxl_state, album, upload_journal, uncommitted)
+
+
+def commit_album(
+    client: upload.Client,
+    pxl_state: state.Overview,
+    album: state.Album,
+    upload_journal: journal.Journal,
+    sources: List[Path],
+) -> state.Overview:
+    """
+    Put an album in the state and upload the new state.
+
+    Afterwards the journal records that the images from `sources` are
+    saved, so they are skipped when resuming.
+    """
+    import pxl.remote as remote
+
+    pxl_state = pxl_state.add_or_replace_album(album)
+    remote.save(client, [album])
+    upload_journal.committed(sources)
+    click.echo(f"Saved state with {len(sources)} new images.", err=True)
+    return pxl_state
+
+
+@cli.command(name="encode-report")
+@click.argument("dir_name")
+@click.option("--limit", default=20, type=int, help="Number of images to encode")
+def encode_report_cmd(dir_name: str, limit: int) -> None:
+    """
+    Compare the encoding profiles with Pillow's defaults.
+    """
+    import pxl.compress as compress
+
+    cfg = config.load()
+    profiles = compress.profiles_from_json(cfg.encoding_profiles)
+
+    dir_path = Path(dir_name)
+    if not dir_path.is_dir():
+        click.echo(f"{dir_path} is not a directory.", err=True)
+        sys.exit(1)
+
+    entries = [entry for entry in sorted(dir_path.iterdir()) if watch.is_jpeg(entry)]
+    results: Dict[state.Size, List[Tuple[compress.EncodeResult, ...]]] = {
+        size: [] for size in profiles
+    }
+    for entry in entries[:limit]:
+        click.echo(f"Encoding {entry}", err=True)
+        for size, result in compress.compare_profiles(entry, profiles).items():
+            results[size].append(result)
+
+    for size, size_results in results.items():
+        if not size_results:
+            continue
+
+        default_bytes = sum(default.num_bytes for default, _ in size_results)
+        profile_bytes = sum(profile.num_bytes for _, profile in size_results)
+        default_seconds = sum(default.seconds for default, _ in size_results)
+        profile_seconds = sum(profile.seconds for _, profile in size_results)
+        mean_quality = sum(profile.quality for _, profile in size_results) / len(
+            size_results
+        )
+        saved = 1 - profile_bytes / default_bytes
+
+        click.echo(f"{size.name} ({len(size_results)} images):")
+        click.echo(
+            f"  size: {default_bytes / 1024:.0f} KiB -> {profile_bytes / 1024:.0f} KiB"
+            f" ({saved:.0%} saved)"
+        )
+        click.echo(f"  time: {default_seconds:.2f} s -> {profile_seconds:.2f} s")
+        click.echo(f"  mean quality: {mean_quality:.1f}")
+
+
+@cli.command(name="import")
+@click.argument("root_name")
+@click.option("--force", is_flag=True, type=bool, help="Force break lock")
+@click.option(
+    "--dry-run", is_flag=True, type=bool, help="Only show what would be imported"
+)
+@click.option("--yes", is_flag=True, type=bool, help="Don't ask for confirmation")
+@click.option("--jobs", default=4, type=int, help="Number of images to process at once")
+@click.option(
+    "--commit-every",
+    default=10,
+    type=int,
+    help="Save the state after every this many albums",
+)
+@duplicate_options
+def import_cmd(
+    root_name: str,
+    force: bool,
+    dry_run: bool,
+    yes: bool,
+    jobs: int,
+    commit_every: int,
+    duplicates: str,
+    duplicate_distance: int,
+    duplicates_in_library: bool,
+) -> None:
+    """
+    Upload every subdirectory of a directory as an album.
+    """
+    import concurrent.futures
+    import pxl.bulk as bulk
+    import pxl.dedupe as dedupe
+    import pxl.journal as journal
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    cfg = config.load()
+
+    root_path = Path(root_name)
+    if not root_path.is_dir():
+        click.echo(f"{root_path} is not a directory.", err=True)
+        sys.exit(1)
+
+    with upload.client(cfg, break_lock=force) as client:
+        try:
+            pxl_state = remote.load(client)
+        except client.boto.exceptions.NoSuchKey as e:
+            pxl_state = state.Overview.empty()
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+
+        plans = bulk.plan_import(root_path, pxl_state)
+        if not plans:
+            click.echo(f"{root_path} does not contain any albums.", err=True)
+            sys.exit(1)
+
+        # Every directory has a journal, like with `pxl upload`. When an
+        # import is run again after it failed, the images that were saved
+        # already are skipped, and partly uploaded images are finished.
+        journals = {
+            dir_path: journal.Journal.load(cfg, dir_path)
+            for dir_path in {entry.parent for plan in plans for entry in plan.files}
+        }
+        albums = {plan.name_display: plan.to_album(pxl_state) for plan in plans}
+
+        def is_imported(plan: bulk.AlbumPlan, entry: Path) -> bool:
+            import_journal = journals[entry.parent]
+            return (
+                import_journal is not None
+                and import_journal.album.name_display == plan.name_display
+                and import_journal.is_committed(entry, albums[plan.name_display])
+            )
 
-        pxl_state = pxl_state.add_or_replace_album(album)
-        upload.private_json(client, json.dumps(pxl_state.to_json()), "state.json")
+        todo = {
+            plan.name_display: [
+                entry for entry in plan.files if not is_imported(plan, entry)
+            ]
+            for plan in plans
+        }
+        for plan in plans:
+            action = "add to" if plan.existing else "create"
+            imported = len(plan.files) - len(todo[plan.name_display])
+            click.echo(
+                f"{action:>6} {plan.created.date()}  {plan.name_display}"
+                f" ({len(plan.files)} images"
+                + (f", {imported} imported already)" if imported else ")")
+            )
+
+        total = sum(len(files) for files in todo.values())
+        click.echo(f"\n{total} images to import in {len(plans)} albums.", err=True)
+
+        if dry_run:
+            return
+
+        if not yes:
+            click.confirm("Continue?", abort=True)
+
+        for plan in plans:
+            for dir_path in {entry.parent for entry in plan.files}:
+                import_journal = journals[dir_path]
+                if (
+                    import_journal is None
+                    or import_journal.album.name_display != plan.name_display
+                ):
+                    journals[dir_path] = journal.Journal.create(
+                        cfg, dir_path, albums[plan.name_display]
+                    )
+
+        def journal_of(entry: Path) -> journal.Journal:
+            import_journal = journals[entry.parent]
+            assert import_journal is not None
+            return import_journal
+
+        def commit(uncommitted: List[Tuple[state.Album, List[Path]]]) -> None:
+            remote.save(client, [album for album, _ in uncommitted])
+            for _, sources in uncommitted:
+                by_dir: Dict[Path, List[Path]] = {}
+                for entry in sources:
+                    by_dir.setdefault(entry.parent, []).append(entry)
+                for entries in by_dir.values():
+                    journal_of(entries[0]).committed(entries)
+
+        detector = dedupe.Detector.from_overview(
+            pxl_state,
+            dedupe.Mode(duplicates),
+            duplicate_distance,
+            library=duplicates_in_library,
+            album_names=[plan.name_display for plan in plans],
+        )
+
+        # Every image of every album goes through the same pool, so
+        # small albums don't leave workers idle. Images are submitted
+        # in album order, so albums finish roughly one after another.
+        uncommitted: List[Tuple[state.Album, List[Path]]] = []
+        failed = 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                pending = [
+                    (
+                        plan,
+                        [
+                            (
+                                entry,
+                                executor.submit(
+                                    upload.public_image_with_size,
+                                    client,
+                                    entry,
+                                    journal_of(entry),
+                                    check=functools.partial(
+                                        detector.check,
+                                        entry,
+                                        album_name=plan.name_display,
+                                    ),
+                                    header=plan.headers[entry],
+                                ),
+                            )
+                            for entry in todo[plan.name_display]
+                        ],
+                    )
+                    for plan in plans
+                ]
+
+                try:
+                    for plan, futures in pending:
+                        album = albums[plan.name_display]
+                        sources = []
+                        for entry, future in futures:
+                            try:
+                                image = future.result()
+                            except Exception as e:
+                                # Like with `upload --watch`, one broken file
+                                # doesn't stop the import.
+                                click.echo(
+                                    f"Skipping {entry}, it failed: {e}", err=True
+                                )
+                                failed += 1
+                                continue
+                            if image is not None:
+                                album = album.add_image(image)
+                                sources.append(entry)
+
+                        # Albums without new images, like a new album of
+                        # which every image was a skipped duplicate, are
+                        # not saved.
+                        if not sources:
+                            click.echo(
+                                f"No new images for {album.name_display}.", err=True
+                            )
+                            continue
+
+                        pxl_state = pxl_state.add_or_replace_album(album)
+                        click.echo(f"Done with {album.name_display}.", err=True)
+
+                        uncommitted.append((album, sources))
+                        if len(uncommitted) >= commit_every:
+                            commit(uncommitted)
+                            uncommitted = []
+                except BaseException:
+                    # Don't start on images that nobody will wait for.
+                    for _, futures in pending:
+                        for _, future in futures:
+                            future.cancel()
+                    raise
+
+        finally:
+            # Even when something failed, save the albums that are done.
+            if uncommitted:
+                commit(uncommitted)
+            print_stats(client)
+
+        if failed:
+            click.echo(
+                f"{failed} images failed. Run the import again to retry them,"
+                " the images that were imported are skipped.",
+                err=True,
+            )
+            sys.exit(1)
+
+        for import_journal in journals.values():
+            if import_journal is not None:
+                import_journal.remove()
+
+
+@cli.command(name="dedupe")
+@click.argument("album_name", required=False)
+@click.option("--force", is_flag=True, type=bool, help="Force break lock")
+@click.option(
+    "--distance",
+    default=6,
+    type=int,
+    help="Number of hash bits in which near-duplicates may differ",
+)
+@click.option(
+    "--library",
+    is_flag=True,
+    type=bool,
+    help="Also report near-duplicates in different albums",
+)
+def dedupe_cmd(
+    album_name: Optional[str], force: bool, distance: int, library: bool
+) -> None:
+    """
+    Report near-duplicate images in one or all albums.
+    """
+    import concurrent.futures
+    import pxl.compress as compress
+    import pxl.dedupe as dedupe
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    cfg = config.load()
+
+    with upload.client(cfg, break_lock=force) as client:
+        try:
+            pxl_state = remote.load(client)
+        except client.boto.exceptions.NoSuchKey as e:
+            click.echo(
+                "Remote state not found. Please upload before continuing.", err=True
+            )
+            sys.exit(1)
+        except Exception as e:
+            click.echo(e, err=True)
+            sys.exit(1)
+
+        albums = pxl_state.albums
+        if album_name is not None:
+            album = pxl_state.get_album_by_name(album_name)
+            if not album:
+                click.echo(f"{album_name} does not exist", err=True)
+                sys.exit(1)
+            albums = [album]
+
+        # Images uploaded before we hashed them get their hash from the
+        # thumbnail, which we store so we only need to do this once.
+        unhashed_albums = [
+            album
+            for album in albums
+            if any(image.dhash is None for image in album.images)
+        ]
+        unhashed = [
+            image
+            for album in unhashed_albums
+            for image in album.images
+            if image.dhash is None
+        ]
+        if unhashed:
+            click.echo(f"Hashing {len(unhashed)} images...", err=True)
+
+            def hash_image(image: state.Image) -> None:
+                object_name = image.get_name("thumbnail_w_400") + ".jpg"
+                image.dhash = compress.dhash_bytes(
+                    upload.get_bytes(client, object_name)
+                )
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(hash_image, unhashed))
+
+            remote.save(client, unhashed_albums)
+
+        album_by_uuid = {
+            image.remote_uuid: album for album in albums for image in album.images
+        }
+        groups = (
+            [[image for album in albums for image in album.images]]
+            if library
+            else [album.images for album in albums]
+        )
+
+        found = 0
+        for images in groups:
+            for original, duplicate, d in dedupe.find_duplicates(images, distance):
+                original_album = album_by_uuid[original.remote_uuid]
+                duplicate_album = album_by_uuid[duplicate.remote_uuid]
+                click.echo(
+                    f"/{duplicate_album.name_nav}/{duplicate.remote_uuid}"
+                    f" looks like /{original_album.name_nav}/{original.remote_uuid}"
+                    f" (distance {d})"
+                )
+                found += 1
+
+        click.echo(f"Found {found} near-duplicates.", err=True)
+
+
+@cli.command(name="fsck")
+@click.option("--force", is_flag=True, type=bool, help="Force break lock")
+@click.option(
+    "--delete-orphans",
+    is_flag=True,
+    type=bool,
+    help="Delete images in the bucket that are not in the state",
+)
+def fsck_cmd(force: bool, delete_orphans: bool) -> None:
+    """
+    Check that the bucket has exactly the images in the state.
+    """
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    cfg = config.load()
+
+    with upload.client(cfg, break_lock=force) as client:
+        try:
+            pxl_state = remote.load(client)
+        except client.boto.exceptions.NoSuchKey as e:
+            click.echo(
+                "Remote state not found. Please upload before continuing.", err=True
+            )
+            sys.exit(1)
+        except Exception as e:
+            click.echo(e, err=True)
+            sys.exit(1)
+
+        # Sizes that alias another size have no object of their own, so
+        # they are neither expected nor missing.
+        expected: Set[str] = set()
+        aliased = 0
+        for album in pxl_state.albums:
+            for image in album.images:
+                expected.update(f"{name}.jpg" for name in image.object_names())
+                aliased += len(image.aliases)
+
+        # Other objects in the bucket, like the state, are none of our
+        # business here.
+        present = {
+            name
+            for name in upload.list_object_names(client)
+            if state.OBJECT_NAME.match(name)
+        }
+
+        missing = sorted(expected - present)
+        orphans = sorted(present - expected)
+        for name in missing:
+            click.echo(f"missing {name}")
+        for name in orphans:
+            click.echo(f"orphan  {name}")
+
+        click.echo(
+            f"{len(expected)} images expected, {aliased} sizes served by"
+            f" another size, {len(missing)} missing, {len(orphans)} orphans.",
+            err=True,
+        )
+
+        if delete_orphans:
+            for name in orphans:
+                upload.delete_image(client, name[: -len(".jpg")])
+
+        if missing:
+            sys.exit(1)
+
+
+@cli.command(name="sprites")
+@click.argument("album_name", required=False)
+@click.option("--force", is_flag=True, type=bool, help="Force break lock")
+@click.option(
+    "--jobs",
+    default=8,
+    type=int,
+    help="Number of thumbnails to download at the same time",
+)
+def sprites_cmd(album_name: Optional[str], force: bool, jobs: int) -> None:
+    """
+    Put the thumbnails of one or all albums on a few large images.
+
+    Album pages then load a few sheets instead of every thumbnail. Only
+    albums whose images changed get new sheets.
+    """
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    cfg = config.load()
+
+    with upload.client(cfg, break_lock=force) as client:
+        try:
+            pxl_state = remote.load(client)
+        except client.boto.exceptions.NoSuchKey as e:
+            click.echo(
+                "Remote state not found. Please upload before continuing.", err=True
+            )
+            sys.exit(1)
+        except Exception as e:
+            click.echo(e, err=True)
+            sys.exit(1)
+
+        albums = pxl_state.albums
+        if album_name is not None:
+            album = pxl_state.get_album_by_name(album_name)
+            if not album:
+                click.echo(f"{album_name} does not exist", err=True)
+                sys.exit(1)
+            albums = [album]
+
+        update_sprites(client, pxl_state, albums, jobs)
+
+
+def update_sprites(
+    client: upload.Client,
+    pxl_state: state.Overview,
+    albums: List[state.Album],
+    jobs: int,
+) -> state.Overview:
+    """Update the sprite sheets of albums, and save the albums that changed."""
+    import pxl.remote as remote
+    import pxl.sprites as sprites
+
+    changed = []
+    for album in albums:
+        updated = sprites.update(client, album, jobs)
+        if updated is None:
+            continue
+
+        click.echo(
+            f"Made sheets for {album.name_display} ({len(updated.sprites)} sheets).",
+            err=True,
+        )
+        pxl_state = pxl_state.edit_album(album, updated)
+        changed.append(updated)
+
+    if changed:
+        remote.save(client, changed)
+    click.echo(f"{len(albums) - len(changed)} albums were up to date.", err=True)
+    return pxl_state
 
 
 @cli.command("build")
 @click.option("--force", is_flag=True, type=bool, help="Force break lock")
-def build_cmd(force: bool) -> None:
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["dir", "tar", "zip"]),
+    default="dir",
+    help="Write a directory, or a single archive (default: dir)",
+)
+@click.option(
+    "--output",
+    "-o",
+    "output_name",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="Archive to write, or - for stdout (default: next to the build directory)",
+)
+@click.option(
+    "--sprites",
+    "make_sprites",
+    is_flag=True,
+    type=bool,
+    help="Update the thumbnail sheets of changed albums first, see `pxl sprites`",
+)
+def build_cmd(
+    force: bool, output_format: str, output_name: Optional[str], make_sprites: bool
+) -> None:
     """Build a static site based on current state."""
-    output_dir = build_path
-    output_dir.mkdir(parents=True, exist_ok=True)
+    import pxl.archive as archive
+    import pxl.generate as generate
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    if output_format == "dir" and output_name is not None:
+        click.echo("--output only applies to --format tar or zip.", err=True)
+        sys.exit(1)
+
+    if output_format == "dir":
+        output_description = str(build_path)
+    elif output_name is None:
+        output_description = str(build_path.parent / f"build.{output_format}")
+    else:
+        output_description = output_name
 
-    click.echo(f"Building site to {output_dir}...", err=True)
+    click.echo(f"Building site to {output_description}...", err=True)
     design_dir = Path(entrypoint) / "design"
 
     cfg = config.load()
-    with upload.client(cfg, break_lock=force) as client:
+    stream: BinaryIO = sys.stdout.buffer
+    with contextlib.ExitStack() as stack:
+        # With the archive on stdout, messages about the lock must not end
+        # up in the archive.
+        if output_description == "-":
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+
+        client = stack.enter_context(upload.client(cfg, break_lock=force))
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            overview = state.Overview.from_json(pxl_state_json)
-            assert overview is not None, "Expected state to be valid"
+            overview = remote.load(client)
         except client.boto.exceptions.NoSuchKey as e:
             click.echo(
                 "Remote state not found. Please upload before continuing.", err=True
@@ -241,18 +1066,251 @@ def build_cmd(force: bool) -> None:
             click.echo(e, err=True)
             sys.exit(1)
 
+        if make_sprites:
+            overview = update_sprites(client, overview, overview.albums, jobs=8)
+
         bucket_puburl = f"https://{cfg.s3_bucket}.{cfg.s3_region}.{cfg.s3_endpoint}"
 
+        output: archive.Output
+        if output_format == "dir":
+            output = archive.DirectoryOutput(build_path)
+        else:
+            if output_description != "-":
+                Path(output_description).parent.mkdir(parents=True, exist_ok=True)
+                stream = stack.enter_context(open(output_description, "wb"))
+            output = stack.enter_context(archive.writer(output_format, stream))
+
         generate.build(
             overview=overview,
-            output_dir=output_dir,
+            output=output,
             template_dir=design_dir,
+            cache_dir=cache_path / "templates",
             bucket_puburl=bucket_puburl,
             public_image_url=cfg.public_image_url,
         )
     click.echo("Done.", err=True)
 
 
+@cli.command("export")
+@click.argument("album_names", nargs=-1)
+@click.option(
+    "--output",
+    "-o",
+    "output_name",
+    required=True,
+    type=click.Path(allow_dash=True),
+    help="Directory or archive to write, or - for stdout",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["dir", "tar", "zip"]),
+    default="dir",
+    help="Write a directory, or a single archive (default: dir)",
+)
+@click.option(
+    "--size",
+    "size_names",
+    multiple=True,
+    type=click.Choice([size.name for size in state.Size]),
+    help="Sizes to export, can be given more than once (default: original)",
+)
+@click.option("--jobs", default=8, type=int, help="Number of files to download at once")
+@click.option(
+    "--restart",
+    is_flag=True,
+    type=bool,
+    help="Start over, instead of continuing an export that was interrupted",
+)
+@click.option("--force", is_flag=True, type=bool, help="Force break lock")
+def export_cmd(
+    album_names: Tuple[str, ...],
+    output_name: str,
+    output_format: str,
+    size_names: Tuple[str, ...],
+    jobs: int,
+    restart: bool,
+    force: bool,
+) -> None:
+    """
+    Download the images of some or all albums.
+
+    Files are named by album and position, like `<album>/0001_o.jpg`, and
+    listed with their checksums in `manifest.json` and `SHA256SUMS`. An
+    interrupted export to a directory or a tar file continues where it
+    stopped.
+    """
+    import pxl.export as export
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    if output_format == "dir" and output_name == "-":
+        click.echo("Only --format tar or zip can be written to stdout.", err=True)
+        sys.exit(1)
+
+    sizes = [state.Size[name] for name in size_names] or [state.Size.original]
+    output_path = None if output_name == "-" else Path(output_name)
+
+    cfg = config.load()
+    stdout: BinaryIO = sys.stdout.buffer
+    with contextlib.ExitStack() as stack:
+        # With the archive on stdout, messages must not end up in it.
+        if output_path is None:
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+
+        client = stack.enter_context(upload.client(cfg, break_lock=force))
+        try:
+            pxl_state = remote.load(client)
+        except client.boto.exceptions.NoSuchKey as e:
+            click.echo(
+                "Remote state not found. Please upload before continuing.", err=True
+            )
+            sys.exit(1)
+        except Exception as e:
+            click.echo(e, err=True)
+            sys.exit(1)
+
+        albums = []
+        for album_name in album_names:
+            album = pxl_state.get_album_by_name(album_name)
+            if not album:
+                click.echo(f"{album_name} does not exist", err=True)
+                sys.exit(1)
+            albums.append(album)
+        if not album_names:
+            albums = pxl_state.albums
+
+        items = export.plan(albums, sizes)
+        output, progress = stack.enter_context(
+            export.open_output(
+                output_format, output_path, resume=not restart, stdout=stdout
+            )
+        )
+        done = len([item for item in items if progress.is_done(item)])
+        if done:
+            click.echo(f"Continuing after {done} of {len(items)} files.", err=True)
+        else:
+            click.echo(f"Exporting {len(items)} files...", err=True)
+
+        export.export(client, items, output, progress, jobs)
+        print_stats(client)
+
+    progress.remove()
+    click.echo("Done.", err=True)
+
+
+@cli.command("regenerate")
+@click.argument("album_names", nargs=-1)
+@click.option(
+    "--size",
+    "size_names",
+    multiple=True,
+    type=click.Choice(
+        [size.name for size in state.Size if size != state.Size.original]
+    ),
+    help="Sizes to make again, can be given more than once (default: all)",
+)
+@click.option(
+    "--only-missing",
+    is_flag=True,
+    type=bool,
+    help="Only do images that don't have all of the sizes yet",
+)
+@click.option("--jobs", default=8, type=int, help="Number of images to process at once")
+@click.option(
+    "--commit-every",
+    default=500,
+    type=int,
+    help="Save the state after every this many images",
+)
+@click.option(
+    "--restart",
+    is_flag=True,
+    type=bool,
+    help="Start over, instead of continuing a run that was interrupted",
+)
+@click.option("--force", is_flag=True, type=bool, help="Force break lock")
+def regenerate_cmd(
+    album_names: Tuple[str, ...],
+    size_names: Tuple[str, ...],
+    only_missing: bool,
+    jobs: int,
+    commit_every: int,
+    restart: bool,
+    force: bool,
+) -> None:
+    """
+    Make the sizes of images again from their originals in the bucket.
+
+    Use this after changing the `encoding_profiles`, or to add sizes to
+    images that don't have them. Sizes whose bytes didn't change are not
+    uploaded again. An interrupted run continues where it stopped.
+    """
+    import pxl.regenerate as regenerate
+    import pxl.remote as remote
+    import pxl.upload as upload
+
+    sizes = [state.Size[name] for name in size_names] or [
+        size for size in state.Size if size != state.Size.original
+    ]
+
+    cfg = config.load()
+    with upload.client(cfg, break_lock=force) as client:
+        try:
+            pxl_state = remote.load(client)
+        except client.boto.exceptions.NoSuchKey as e:
+            click.echo(
+                "Remote state not found. Please upload before continuing.", err=True
+            )
+            sys.exit(1)
+        except Exception as e:
+            click.echo(e, err=True)
+            sys.exit(1)
+
+        summaries = pxl_state.summaries
+        if album_names:
+            by_name = {summary.name_display: summary for summary in summaries}
+            missing = [name for name in album_names if name not in by_name]
+            if missing:
+                click.echo(f"{', '.join(missing)} does not exist", err=True)
+                sys.exit(1)
+            summaries = [by_name[name] for name in album_names]
+
+        progress_path = regenerate.progress_path(cfg, sizes)
+        if restart and progress_path.exists():
+            progress_path.unlink()
+        progress = regenerate.Progress.load(progress_path)
+        if progress.done:
+            click.echo(
+                f"Continuing after {len(progress.done)} images that are done.",
+                err=True,
+            )
+
+        total = sum(summary.image_count for summary in summaries)
+        click.echo(
+            f"Regenerating {', '.join(size.name for size in sizes)}"
+            f" for up to {total} images in {len(summaries)} albums...",
+            err=True,
+        )
+        try:
+            stats = regenerate.run(
+                client,
+                summaries,
+                sizes,
+                progress,
+                only_missing=only_missing,
+                jobs=jobs,
+                commit_every=commit_every,
+            )
+        finally:
+            print_stats(client)
+
+    # Images of other albums may still have to be saved by a next run.
+    if not progress.unsaved:
+        progress.remove()
+    click.echo(f"Done: {stats.summary()}.", err=True)
+
+
 @cli.command("preview")
 @click.option("--port", default=8000, type=int, help="Port to use")
 @click.option("--bind", default="", help="Address to bind on (default: all interfaces)")
@@ -263,6 +1321,9 @@ def preview_cmd(port: int, bind: str) -> None:
         click.echo("No output to serve. Please run `pxl build` first.", err=True)
         sys.exit(1)
 
+    import http.server
+    import socketserver
+
     click.launch(f"http://localhost:{port}")
 
     # Start the default Python HTTP server.
@@ -287,6 +1348,8 @@ def preview_cmd(port: int, bind: str) -> None:
 @cli.command("deploy")
 def deploy_cmd() -> None:
     """Deploy the static output."""
+    import subprocess
+
     if not config.is_initialized():
         click.echo("Config not initialized. Please run `pxl init` first.", err=False)
         sys.exit(1)
@@ -363,14 +1426,15 @@ def delete_cmd(album_name: str, force: bool) -> None:
     """
     Delete an album and its pictures.
     """
+    import pxl.remote as remote
+    import pxl.upload as upload
+
     cfg = config.load()
 
     with upload.client(cfg, break_lock=force) as client:
 
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            pxl_state = state.Overview.from_json(pxl_state_json)
-            assert pxl_state is not None, "Expected state to be valid"
+            pxl_state = remote.load(client)
         except client.boto.exceptions.NoSuchKey as e:
             pxl_state = state.Overview.empty()
         except Exception as e:
@@ -384,9 +1448,10 @@ def delete_cmd(album_name: str, force: bool) -> None:
         if album:
             click.echo("Album found, deleting pictures...")
             for image in album.images:
-                upload.delete_image(client, image.get_name("original"))
-                upload.delete_image(client, image.get_name("display_w_1600"))
-                upload.delete_image(client, image.get_name("thumbnail_w_400"))
+                for object_name in image.object_names():
+                    upload.delete_image(client, object_name)
+            for sheet in album.sprites:
+                upload.delete_image(client, sheet.name)
 
         else:
             click.echo("Given album not found")
@@ -395,7 +1460,7 @@ def delete_cmd(album_name: str, force: bool) -> None:
         click.echo("deleting album...")
 
         pxl_state = pxl_state.remove_album(album)
-        upload.private_json(client, json.dumps(pxl_state.to_json()), "state.json")
+        remote.save(client, [], removed=[album])
 
         click.echo("deleted album, please run build and deploy now")
 
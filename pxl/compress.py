@@ -1,63 +1,329 @@
-import tempfile
+from __future__ import annotations
+
+import io
 import pathlib
+import time
 
-from typing import Any, Dict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
 
-from PIL import Image  # type: ignore
+from PIL import Image, ImageMath  # type: ignore
 
 from pxl import state
 
 
-def compress_image(local_filename: pathlib.Path) -> Dict[state.Size, pathlib.Path]:
+@dataclass
+class EncodingProfile:
+    """
+    Settings for encoding one size of an image as JPEG.
+
+    With a `target_ssim`, the quality is searched between `min_quality`
+    and `quality`: we pick the lowest quality at which the image is still
+    this similar to the unencoded image, as measured with `ssim`.
+    """
+
+    quality: int
+    progressive: bool = True
+    optimize: bool = True
+    subsampling: str = "4:2:0"
+    target_ssim: Optional[float] = None
+    min_quality: int = 50
+
+    @classmethod
+    def from_json(
+        cls, json: Dict[str, Any], default: EncodingProfile
+    ) -> EncodingProfile:
+        return cls(
+            quality=json.get("quality", default.quality),
+            progressive=json.get("progressive", default.progressive),
+            optimize=json.get("optimize", default.optimize),
+            subsampling=json.get("subsampling", default.subsampling),
+            target_ssim=json.get("target_ssim", default.target_ssim),
+            min_quality=json.get("min_quality", default.min_quality),
+        )
+
+
+# The original is never encoded, so it has no profile.
+DEFAULT_PROFILES = {
+    state.Size.display_w_1600: EncodingProfile(quality=80),
+    state.Size.thumbnail_w_400: EncodingProfile(quality=75),
+}
+
+# Pillow's settings when you don't pass any, to compare profiles with.
+PILLOW_PROFILE = EncodingProfile(
+    quality=75, progressive=False, optimize=False, subsampling="4:2:0"
+)
+
+
+@dataclass
+class EncodeResult:
+    quality: int
+    num_bytes: int
+    # Number of times the image was encoded to find the quality.
+    attempts: int
+    seconds: float
+
+
+def profiles_from_json(json: Dict[str, Any]) -> Dict[state.Size, EncodingProfile]:
+    """
+    Read the `encoding_profiles` from the config, which map size names to
+    settings. Settings that are not in the config keep their default.
+    """
+    profiles = dict(DEFAULT_PROFILES)
+    for size_name, profile_json in json.items():
+        size = state.Size[size_name]
+        if size not in profiles:
+            raise ValueError(f"{size_name} is never encoded, it has no profile")
+
+        profiles[size] = EncodingProfile.from_json(profile_json, profiles[size])
+
+    return profiles
+
+
+@dataclass
+class CompressedImage:
+    # The compressed sizes, in a temporary directory. Sizes that alias
+    # another size have the path of that size.
+    paths: Dict[state.Size, pathlib.Path]
+    aliases: Dict[state.Size, state.Size]
+    dhash: int
+    # Dimensions of the original, after rotating it upright.
+    width: int
+    height: int
+
+
+def compress_image(
+    local_filename: pathlib.Path,
+    tempdir: pathlib.Path,
+    profiles: Dict[state.Size, EncodingProfile] = DEFAULT_PROFILES,
+) -> CompressedImage:
     """
     Compresses the image to different sizes.
-    Returns a Dict of `state.Size`s to `Path`s in a temporary directory.
+    Returns the paths of all sizes in `tempdir`.
+
+    Images with the same filename from different directories can be
+    compressed at the same time, so every image needs its own `tempdir`.
     """
     sizes_to_generate = [state.Size.thumbnail_w_400, state.Size.display_w_1600]
     image_paths: Dict[state.Size, pathlib.Path] = {}
-    tempdir = pathlib.Path(tempfile.gettempdir())
+    aliases: Dict[state.Size, state.Size] = {}
 
     with Image.open(local_filename, "r") as image:
-        image = orient_exif(image)
-
+        # The original is not decoded and encoded again, that would cost
+        # quality and a lot of time. We only strip the metadata from the
+        # file, except for the orientation, so viewers still rotate it.
         original_tmp_path = tempdir / local_filename.name
-        image = image.convert("RGB")
-        image.save(original_tmp_path)
+        original_tmp_path.write_bytes(
+            strip_metadata(local_filename.read_bytes(), exif_orientation(image))
+        )
         image_paths[state.Size.original] = original_tmp_path
 
+        image = orient_exif(image)
+        image = image.convert("RGB")
+
         # Get the original dimensions
         real_w, real_h = image.size
+        image_dhash: Optional[int] = None
         for size_to_generate in sizes_to_generate:
-            # Prevent upscaling
+            # Prevent upscaling. The original serves as this size, so we
+            # don't need to encode, store and upload another copy of it.
             w = size_to_generate.max_width
             if w >= real_w:
                 image_paths[size_to_generate] = original_tmp_path
+                aliases[size_to_generate] = state.Size.original
+                continue
 
-            # Copy original image
-            scaled = image.copy()
-            # Calculate scaling by preserving aspect ratio
-            size = w, real_h * (w / real_w)
-            # Scale the image
-            scaled.thumbnail(size, Image.ANTIALIAS)
+            scaled = scale(image, size_to_generate)
+            if size_to_generate == state.Size.thumbnail_w_400:
+                # Hashing the thumbnail is much cheaper than the full image.
+                image_dhash = dhash(scaled)
             # Save the image with a width specification
-            scaled_path = pathlib.Path(tempfile.gettempdir()).joinpath(
-                f"{local_filename.stem}-w{size[0]}.jpeg"
-            )
-            scaled.save(scaled_path, image.format)
+            scaled_path = tempdir / f"{local_filename.stem}-w{w}.jpeg"
+            data, _ = encode(scaled, profiles[size_to_generate])
+            scaled_path.write_bytes(data)
 
             # Add the path to the output list
             image_paths[size_to_generate] = scaled_path
 
-    return image_paths
+        if image_dhash is None:
+            # Small images don't have a thumbnail of their own.
+            image_dhash = dhash(image)
 
+    return CompressedImage(
+        paths=image_paths,
+        aliases=aliases,
+        dhash=image_dhash,
+        width=real_w,
+        height=real_h,
+    )
 
-def orient_exif(image: Any) -> Any:
+
+def compare_profiles(
+    local_filename: pathlib.Path, profiles: Dict[state.Size, EncodingProfile]
+) -> Dict[state.Size, Tuple[EncodeResult, EncodeResult]]:
     """
-    Rotate the image according to EXIF metadata.
+    Encode every size of an image with Pillow's defaults and with its
+    profile. Returns both results for every size, in that order.
+    """
+    results = {}
+    with Image.open(local_filename, "r") as image:
+        image = orient_exif(image).convert("RGB")
+        for size, profile in profiles.items():
+            scaled = scale(image, size)
+            _, default_result = encode(scaled, PILLOW_PROFILE)
+            _, profile_result = encode(scaled, profile)
+            results[size] = (default_result, profile_result)
+
+    return results
+
+
+def scale(image: Any, size: state.Size) -> Any:
+    """
+    Scale an image down to the width of `size`.
+    """
+    real_w, real_h = image.size
+    w = size.max_width
+
+    # Copy original image
+    scaled = image.copy()
+    # Scale the image, preserving the aspect ratio
+    scaled.thumbnail((w, real_h * (w / real_w)), Image.ANTIALIAS)
+    return scaled
+
+
+def encode(image: Any, profile: EncodingProfile) -> Tuple[bytes, EncodeResult]:
+    """
+    Encode an image as JPEG according to the profile.
+    """
+    start = time.perf_counter()
+
+    def encode_with_quality(quality: int) -> bytes:
+        output = io.BytesIO()
+        image.save(
+            output,
+            "JPEG",
+            quality=quality,
+            progressive=profile.progressive,
+            optimize=profile.optimize,
+            subsampling=profile.subsampling,
+        )
+        return output.getvalue()
+
+    data = encode_with_quality(profile.quality)
+    quality = profile.quality
+    attempts = 1
+
+    if profile.target_ssim is not None:
+        # Binary search for the lowest quality that still reaches the
+        # target. The encoding at `profile.quality` is the fallback, when
+        # even that does not reach the target.
+        reference = luma(image)
+        low, high = profile.min_quality, profile.quality - 1
+        while low <= high:
+            middle = (low + high) // 2
+            candidate = encode_with_quality(middle)
+            attempts += 1
+
+            with Image.open(io.BytesIO(candidate)) as decoded:
+                similarity = ssim(reference, luma(decoded))
+
+            if similarity >= profile.target_ssim:
+                data, quality = candidate, middle
+                high = middle - 1
+            else:
+                low = middle + 1
+
+    seconds = time.perf_counter() - start
+    return data, EncodeResult(quality, len(data), attempts, seconds)
+
+
+def dhash(image: Any) -> int:
+    """
+    Compute the 64 bit difference hash of an image.
+
+    The image is scaled down to 9x8 gray pixels, and every bit tells
+    whether a pixel is brighter than its right neighbour. Images that
+    look alike have hashes that differ in only a few bits, even after
+    scaling, compression or small edits.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.BOX).getdata())
+
+    result = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            result = (result << 1) | (left > right)
+
+    return result
+
+
+def dhash_bytes(data: bytes) -> int:
+    """
+    Compute the difference hash of an encoded image.
+
+    Originals keep their EXIF orientation, so they are rotated upright
+    first, like `compress_image` does before hashing.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        return dhash(orient_exif(image))
+
+
+def luma(image: Any) -> Any:
+    """
+    The brightness channel of an image, as floats.
+    """
+    return image.convert("L").convert("F")
+
+
+# Constants from "Image quality assessment: From error visibility to
+# structural similarity" by Wang et al., for 8 bit channels.
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_BLOCK_SIZE = 8
+
+
+def ssim(x: Any, y: Any) -> float:
+    """
+    Compute the structural similarity of two luma images.
+
+    This is the mean SSIM over blocks of 8x8 pixels, instead of over a
+    sliding gaussian window. That is less precise, but we can do it all
+    in Pillow: the mean of every block is a box filtered resize, and the
+    variances follow from the means of the squared images.
+    """
+    w, h = x.size
+    blocks = (max(1, w // SSIM_BLOCK_SIZE), max(1, h // SSIM_BLOCK_SIZE))
+
+    def block_means(expression: str) -> List[float]:
+        product = ImageMath.eval(expression, x=x, y=y)
+        return list(product.resize(blocks, Image.BOX).getdata())
+
+    means_x = block_means("x")
+    means_y = block_means("y")
+    means_xx = block_means("x * x")
+    means_yy = block_means("y * y")
+    means_xy = block_means("x * y")
+
+    total = 0.0
+    for mx, my, mxx, myy, mxy in zip(means_x, means_y, means_xx, means_yy, means_xy):
+        var_x = mxx - mx * mx
+        var_y = myy - my * my
+        cov_xy = mxy - mx * my
+        total += ((2 * mx * my + SSIM_C1) * (2 * cov_xy + SSIM_C2)) / (
+            (mx * mx + my * my + SSIM_C1) * (var_x + var_y + SSIM_C2)
+        )
+
+    return total / len(means_x)
+
+
+def exif_orientation(image: Any) -> Optional[int]:
+    """
+    Read the orientation from the EXIF metadata.
     """
     exif_data = image._getexif()
     if not (exif_data):
-        return image
+        return None
 
     # EXIF metadata is a binary format. The magic number below stands for
     # the part of the metadata which all compliant software uses as the
@@ -67,6 +333,18 @@ def orient_exif(image: Any) -> Any:
     orientation_tag = 274
     orientation = exif_data.get(orientation_tag)
 
+    if not isinstance(orientation, int):
+        return None
+
+    return orientation
+
+
+def orient_exif(image: Any) -> Any:
+    """
+    Rotate the image according to EXIF metadata.
+    """
+    orientation = exif_orientation(image)
+
     if orientation is None:
         return image
 
@@ -91,3 +369,100 @@ def orient_exif(image: Any) -> Any:
 
     # In the unlikely case rotation exif tag is 0 or higher then 9
     return image
+
+
+# JPEG markers, see https://www.w3.org/Graphics/JPEG/itu-t81.pdf, table B.1.
+MARKER_SOI = 0xD8
+MARKER_EOI = 0xD9
+MARKER_SOS = 0xDA
+MARKER_APP0 = 0xE0
+MARKER_APP1 = 0xE1
+MARKER_APP2 = 0xE2
+MARKER_APP14 = 0xEE
+MARKER_COM = 0xFE
+
+
+def strip_metadata(data: bytes, orientation: Optional[int]) -> bytes:
+    """
+    Remove metadata from a JPEG file without decoding it.
+
+    A JPEG file is a list of segments, followed by the compressed image
+    data. We copy all segments that are needed to decode the image, and
+    drop the ones with metadata: EXIF and XMP (APP1), maker notes and
+    other application data, and comments. The segments that influence
+    the colors are kept: JFIF (APP0), the ICC profile (APP2) and the
+    Adobe color transform (APP14). Anything after the end of the image,
+    like the previews some cameras append, is dropped too.
+
+    When the image needs to be rotated, we write a new EXIF segment that
+    only contains the orientation.
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+
+    result = [data[:2]]
+    if orientation is not None and orientation != 1:
+        result.append(orientation_segment(orientation))
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("Corrupt JPEG file")
+
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Markers may be preceded by any number of fill bytes.
+            pos += 1
+            continue
+
+        length = int.from_bytes(data[pos + 2 : pos + 4], "big")
+        segment = data[pos : pos + 2 + length]
+        pos += 2 + length
+
+        if marker == MARKER_SOS:
+            # The rest is compressed image data, up to the End Of Image
+            # marker. Inside the image data, 0xFF bytes are always
+            # followed by 0x00 or a restart marker, so the first 0xFFD9
+            # is the real end.
+            end = data.find(b"\xff\xd9", pos)
+            result.append(segment)
+            result.append(data[pos:] if end == -1 else data[pos : end + 2])
+            break
+
+        if marker == MARKER_COM:
+            continue
+        if marker == MARKER_APP2 and not segment[4:].startswith(b"ICC_PROFILE\x00"):
+            continue
+        if MARKER_APP1 <= marker < MARKER_APP14 and marker != MARKER_APP2:
+            continue
+        if marker == MARKER_APP14 + 1:
+            # APP15 is only ever used for metadata.
+            continue
+
+        result.append(segment)
+
+    return b"".join(result)
+
+
+def orientation_segment(orientation: int) -> bytes:
+    """
+    Build an EXIF segment with just the orientation tag.
+    """
+    tiff = b"".join(
+        [
+            # Big endian TIFF header, the first IFD starts at offset 8.
+            b"MM\x00\x2a\x00\x00\x00\x08",
+            # One IFD entry: orientation (274), a SHORT, one value.
+            (1).to_bytes(2, "big"),
+            (274).to_bytes(2, "big"),
+            (3).to_bytes(2, "big"),
+            (1).to_bytes(4, "big"),
+            orientation.to_bytes(2, "big") + b"\x00\x00",
+            # There is no next IFD.
+            (0).to_bytes(4, "big"),
+        ]
+    )
+    payload = b"Exif\x00\x00" + tiff
+    return (
+        b"\xff" + bytes([MARKER_APP1]) + (len(payload) + 2).to_bytes(2, "big") + payload
+    )
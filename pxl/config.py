@@ -3,7 +3,7 @@ from __future__ import annotations
 import json
 import sys
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
@@ -22,8 +22,10 @@ class Config:
     deploy_user: str
     deploy_path: str
     public_image_url: str
+    # Maps size names to JPEG encoding settings, see `compress.EncodingProfile`.
+    encoding_profiles: Dict[str, Dict[str, Any]] = field(default_factory=dict)
 
-    def to_json(self) -> Dict[str, str]:
+    def to_json(self) -> Dict[str, Any]:
         return {
             "s3_endpoint": self.s3_endpoint,
             "s3_region": self.s3_region,
@@ -34,6 +36,7 @@ class Config:
             "deploy_user": self.deploy_user,
             "deploy_path": self.deploy_path,
             "public_image_url": self.public_image_url,
+            "encoding_profiles": self.encoding_profiles,
         }
 
     @classmethod
@@ -48,6 +51,7 @@ class Config:
             deploy_user=json["deploy_user"],
             deploy_path=json["deploy_path"],
             public_image_url=json.get("public_image_url", ""),
+            encoding_profiles=json.get("encoding_profiles", {}),
         )
 
 
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import threading
+
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Generic, List, Optional, Tuple, TypeVar
+
+import pxl.state as state
+
+T = TypeVar("T")
+
+
+def distance(a: int, b: int) -> int:
+    """The number of bits in which two hashes differ."""
+    return bin(a ^ b).count("1")
+
+
+@dataclass
+class BKNode(Generic[T]):
+    dhash: int
+    item: T
+    children: Dict[int, BKNode[T]] = field(default_factory=dict)
+
+
+@dataclass
+class BKTree(Generic[T]):
+    """
+    Burkhard-Keller tree of hashes, to find near-duplicates quickly.
+
+    Every child of a node is at a distinct distance from it. Because the
+    Hamming distance is a metric, all hashes within `max_distance` of a
+    query are in children at `d - max_distance` up to `d + max_distance`
+    from a node at distance `d`, so most of the tree is never visited.
+    """
+
+    root: Optional[BKNode[T]] = None
+
+    def add(self, dhash: int, item: T) -> None:
+        if self.root is None:
+            self.root = BKNode(dhash, item)
+            return
+
+        node = self.root
+        while True:
+            d = distance(dhash, node.dhash)
+            child = node.children.get(d)
+            if child is None:
+                node.children[d] = BKNode(dhash, item)
+                return
+            node = child
+
+    def search(self, dhash: int, max_distance: int) -> List[Tuple[int, T]]:
+        """Find all items within `max_distance`, nearest first."""
+        result = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            d = distance(dhash, node.dhash)
+            if d <= max_distance:
+                result.append((d, node.item))
+
+            for child_distance, child in node.children.items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    nodes.append(child)
+
+        result.sort(key=lambda match: match[0])
+        return result
+
+
+class Mode(Enum):
+    # Upload near-duplicates, but print them.
+    report = "report"
+    # Upload near-duplicates, and record the image they duplicate.
+    flag = "flag"
+    # Don't upload near-duplicates.
+    skip = "skip"
+
+
+@dataclass
+class Detector:
+    """
+    Finds near-duplicates of images while they are uploaded.
+
+    Every checked image is added to the index, so duplicates within one
+    upload are found too. With `library` set, an image is compared to all
+    images in the library, otherwise only to the album it goes into.
+    """
+
+    mode: Mode
+    max_distance: int
+    library: bool
+    indexes: Dict[str, BKTree[state.Image]] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def from_overview(
+        cls,
+        overview: state.Overview,
+        mode: Mode,
+        max_distance: int,
+        library: bool,
+        album_names: List[str],
+    ) -> Detector:
+        """
+        Index the images that uploads to `album_names` are compared to.
+        Without `library`, only those albums are loaded.
+        """
+        detector = cls(mode=mode, max_distance=max_distance, library=library)
+        if library:
+            albums = overview.albums
+        else:
+            albums = state.filter_optionals(
+                [overview.get_album_by_name(name) for name in album_names]
+            )
+
+        for album in albums:
+            index = detector.index(album.name_display)
+            for image in album.images:
+                if image.dhash is not None:
+                    index.add(image.dhash, image)
+
+        return detector
+
+    def index(self, album_name: str) -> BKTree[state.Image]:
+        key = "" if self.library else album_name
+        return self.indexes.setdefault(key, BKTree())
+
+    def check(self, source: Path, image: state.Image, album_name: str) -> bool:
+        """
+        Check an image before it is uploaded. Returns whether to upload it.
+        """
+        if image.dhash is None:
+            return True
+
+        with self.lock:
+            index = self.index(album_name)
+            matches = index.search(image.dhash, self.max_distance)
+            if not matches:
+                index.add(image.dhash, image)
+                return True
+
+            d, original = matches[0]
+            print(f"{source} looks like {original.remote_uuid} (distance {d}).")
+
+            if self.mode == Mode.skip:
+                print(f"Skipping {source}.")
+                return False
+
+            if self.mode == Mode.flag:
+                image.duplicate_of = original.remote_uuid
+
+            index.add(image.dhash, image)
+            return True
+
+
+def find_duplicates(
+    images: List[state.Image], max_distance: int
+) -> List[Tuple[state.Image, state.Image, int]]:
+    """
+    Find all pairs of near-duplicates, in the order of `images`.
+    """
+    result = []
+    index: BKTree[state.Image] = BKTree()
+    for image in images:
+        if image.dhash is None:
+            continue
+
+        for d, original in index.search(image.dhash, max_distance):
+            result.append((original, image, d))
+
+        index.add(image.dhash, image)
+
+    return result
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import concurrent.futures
+import datetime
+import struct
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+# Start Of Frame markers, which hold the dimensions of the image. These
+# are 0xC0 to 0xCF, except for DHT (0xC4), JPG (0xC8) and DAC (0xCC).
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+MARKER_SOS = 0xDA
+MARKER_APP1 = 0xE1
+
+# EXIF tags, see https://www.exif.org/Exif2-2.PDF, section 4.6.
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_ORIENTATION = 0x0112
+TAG_DATE_TIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_TIME_ORIGINAL = 0x9003
+
+TYPE_ASCII = 2
+TYPE_SHORT = 3
+
+
+@dataclass
+class Header:
+    # Dimensions after rotating the image upright.
+    width: Optional[int] = None
+    height: Optional[int] = None
+    orientation: Optional[int] = None
+    captured: Optional[datetime.datetime] = None
+    camera: Optional[str] = None
+
+
+def read_header(path: Path) -> Header:
+    """
+    Read the EXIF metadata and dimensions of a JPEG file.
+
+    Unlike opening the image with Pillow, this only reads the segments
+    at the start of the file, up to the compressed image data. It never
+    decodes any pixels, and reads only a few kilobytes of most files.
+    Files we can't parse get an empty header.
+    """
+    header = Header()
+    try:
+        with path.open("rb") as f:
+            read_segments(f, header)
+    except (OSError, ValueError, struct.error):
+        pass
+
+    # Orientations 5 to 8 rotate the image by 90 degrees.
+    if header.orientation in [5, 6, 7, 8]:
+        header.width, header.height = header.height, header.width
+
+    return header
+
+
+def read_segments(f: BinaryIO, header: Header) -> None:
+    if f.read(2) != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+
+    while True:
+        marker_bytes = f.read(2)
+        if len(marker_bytes) < 2 or marker_bytes[0] != 0xFF:
+            return
+
+        marker = marker_bytes[1]
+        if marker == 0xFF:
+            # Fill byte, the marker follows.
+            f.seek(-1, 1)
+            continue
+
+        if marker == MARKER_SOS:
+            return
+
+        (length,) = struct.unpack(">H", f.read(2))
+        if marker == MARKER_APP1:
+            payload = f.read(length - 2)
+            if payload.startswith(b"Exif\x00\x00"):
+                read_tiff(payload[6:], header)
+        elif marker in SOF_MARKERS:
+            payload = f.read(length - 2)
+            header.height, header.width = struct.unpack(">HH", payload[1:5])
+            # The frame comes after the metadata, so we're done.
+            return
+        else:
+            f.seek(length - 2, 1)
+
+
+def read_tiff(tiff: bytes, header: Header) -> None:
+    """
+    Read the tags we need from the TIFF structure inside the EXIF segment.
+    """
+    byte_order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if byte_order is None:
+        raise ValueError("Invalid TIFF header")
+
+    (ifd0_offset,) = struct.unpack(byte_order + "I", tiff[4:8])
+    ifd0 = read_ifd(tiff, byte_order, ifd0_offset)
+
+    make = ascii_value(tiff, byte_order, ifd0.get(TAG_MAKE))
+    model = ascii_value(tiff, byte_order, ifd0.get(TAG_MODEL))
+    # Most models already start with the make, like "Canon EOS 80D".
+    if make and model and not model.startswith(make):
+        header.camera = f"{make} {model}"
+    else:
+        header.camera = model or make
+
+    orientation = ifd0.get(TAG_ORIENTATION)
+    if orientation is not None and orientation[0] == TYPE_SHORT:
+        header.orientation = short_value(byte_order, orientation[2])
+
+    captured = ascii_value(tiff, byte_order, ifd0.get(TAG_DATE_TIME))
+    exif_ifd = ifd0.get(TAG_EXIF_IFD)
+    if exif_ifd is not None:
+        (exif_offset,) = struct.unpack(byte_order + "I", exif_ifd[2])
+        exif = read_ifd(tiff, byte_order, exif_offset)
+        captured = (
+            ascii_value(tiff, byte_order, exif.get(TAG_DATE_TIME_ORIGINAL)) or captured
+        )
+
+    header.captured = parse_datetime(captured)
+
+
+# An IFD entry is a type, a count and four bytes that hold either the
+# value or the offset of the value.
+Entry = Tuple[int, int, bytes]
+
+
+def read_ifd(tiff: bytes, byte_order: str, offset: int) -> Dict[int, Entry]:
+    (count,) = struct.unpack(byte_order + "H", tiff[offset : offset + 2])
+    entries = {}
+    for i in range(count):
+        start = offset + 2 + i * 12
+        tag, value_type, value_count = struct.unpack(
+            byte_order + "HHI", tiff[start : start + 8]
+        )
+        entries[tag] = (value_type, value_count, tiff[start + 8 : start + 12])
+
+    return entries
+
+
+def short_value(byte_order: str, value: bytes) -> int:
+    result: int = struct.unpack(byte_order + "H", value[:2])[0]
+    return result
+
+
+def ascii_value(tiff: bytes, byte_order: str, entry: Optional[Entry]) -> Optional[str]:
+    if entry is None or entry[0] != TYPE_ASCII:
+        return None
+
+    _, count, value = entry
+    if count > 4:
+        (offset,) = struct.unpack(byte_order + "I", value)
+        value = tiff[offset : offset + count]
+
+    return value[:count].split(b"\x00", 1)[0].decode("ascii", "replace").strip() or None
+
+
+def parse_datetime(value: Optional[str]) -> Optional[datetime.datetime]:
+    # EXIF dates look like "2019:03:23 21:05:44".
+    if value is None:
+        return None
+
+    try:
+        return datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def scan(paths: List[Path], jobs: int = 16) -> Dict[Path, Header]:
+    """
+    Read the headers of many files at once.
+
+    Reading a header is mostly waiting for the disk, so this uses threads.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(paths, executor.map(read_header, paths)))
+
+
+def capture_order(path: Path, header: Header) -> Tuple[bool, datetime.datetime, str]:
+    """
+    Sort key for images: by capture time, and by name when that's equal.
+    Images without a capture time come last.
+    """
+    return (
+        header.captured is None,
+        header.captured or datetime.datetime.min,
+        path.name,
+    )
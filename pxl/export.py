@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import sys
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import pxl.archive as archive
+import pxl.state as state
+import pxl.upload as upload
+import pxl.work as work
+
+# Objects are downloaded in parts of this size, in parallel.
+PART_SIZE = 8 * 1024 * 1024
+
+# Written last, so an export with a manifest is complete.
+MANIFEST_NAME = "manifest.json"
+CHECKSUMS_NAME = "SHA256SUMS"
+
+# Where the progress of an export to a directory is kept, so an export
+# that was interrupted can continue where it stopped.
+DIRECTORY_PROGRESS_NAME = ".pxl-export-progress.jsonl"
+
+
+@dataclass
+class Item:
+    # Path in the export, like "spring-drinks/0001_o.jpg".
+    path: str
+    object_name: str
+    album: state.Album
+    image: state.Image
+    size: state.Size
+
+
+def plan(albums: List[state.Album], sizes: List[state.Size]) -> List[Item]:
+    """
+    The files of an export, named by album and position in the album.
+    """
+    items = []
+    for album in albums:
+        width = max(4, len(str(len(album.images))))
+        for position, image in enumerate(album.images, 1):
+            object_names = set()
+            for size in sizes:
+                if size not in image.available_sizes:
+                    continue
+
+                # A size that aliases another size we export is the same file.
+                object_name = image.get_name(size.name) + ".jpg"
+                if object_name in object_names:
+                    continue
+                object_names.add(object_name)
+
+                items.append(
+                    Item(
+                        path=f"{album.name_nav}/{position:0{width}d}{size.path_suffix}.jpg",
+                        object_name=object_name,
+                        album=album,
+                        image=image,
+                        size=size,
+                    )
+                )
+
+    return items
+
+
+@dataclass
+class Progress:
+    """
+    The files that are in the export already, with a record in a log for
+    every file.
+
+    For a tar archive, every record also has the end of the archive after
+    that file. A resumed export cuts the archive there, which removes a
+    file that was written only partially. Records are only appended once
+    the files before them are synced to disk, so they never point past
+    the bytes that are there.
+    """
+
+    log: Optional[work.Log]
+    entries: Dict[str, Dict[str, Any]]
+    offset: int = 0
+
+    @classmethod
+    def load(cls, path: Optional[Path]) -> Progress:
+        if path is None:
+            return cls(log=None, entries={})
+
+        log = work.Log(path)
+        progress = cls(log=log, entries={})
+        for record in log.read():
+            progress.entries[record["entry"]["path"]] = record["entry"]
+            progress.offset = record["offset"]
+
+        return progress
+
+    def is_done(self, item: Item) -> bool:
+        entry = self.entries.get(item.path)
+        return entry is not None and entry["object_name"] == item.object_name
+
+    def append(self, entry: Dict[str, Any], offset: int) -> None:
+        self.entries[entry["path"]] = entry
+        self.offset = offset
+        if self.log is not None:
+            self.log.append({"entry": entry, "offset": offset})
+
+    def remove(self) -> None:
+        if self.log is not None:
+            self.log.remove()
+
+
+@contextmanager
+def open_output(
+    output_format: str, path: Optional[Path], resume: bool, stdout: BinaryIO
+) -> Iterator[Tuple[archive.Output, Progress]]:
+    """
+    Open the output of an export, a directory or an archive at `path`,
+    or an archive on `stdout` without a `path`.
+
+    With `resume`, continue the export that is there already. Only
+    directories and tar files can be resumed.
+    """
+    if output_format == "dir":
+        assert path is not None
+        progress = Progress.load(path / DIRECTORY_PROGRESS_NAME)
+        if not resume:
+            progress.remove()
+            progress.entries = {}
+
+        # Files that were removed or changed since are downloaded again.
+        for name, entry in list(progress.entries.items()):
+            file_path = path / name
+            if not file_path.is_file() or file_path.stat().st_size != entry["bytes"]:
+                del progress.entries[name]
+
+        yield archive.DirectoryOutput(path, clear=False), progress
+        return
+
+    if path is None:
+        with archive.writer(output_format, stdout, compress=False) as output:
+            yield output, Progress(log=None, entries={})
+        return
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    progress = Progress.load(path.with_name(path.name + ".progress.jsonl"))
+    stream: BinaryIO
+    if resume and output_format == "tar" and path.exists():
+        stream = path.open("r+b")
+        stream.truncate(progress.offset)
+        stream.seek(progress.offset)
+    else:
+        progress.remove()
+        progress = Progress(log=progress.log, entries={})
+        stream = path.open("wb")
+
+    with stream, archive.writer(output_format, stream, compress=False) as output:
+        yield output, progress
+
+
+def download(
+    client: upload.Client,
+    object_name: str,
+    parts_executor: concurrent.futures.ThreadPoolExecutor,
+) -> bytes:
+    """
+    Download an object. Large objects are downloaded in parts, at the
+    same time.
+    """
+    first, size = upload.get_range(client, object_name, 0, PART_SIZE - 1)
+    if size <= len(first):
+        return first
+
+    parts = [
+        parts_executor.submit(
+            upload.get_range,
+            client,
+            object_name,
+            start,
+            min(start + PART_SIZE, size) - 1,
+        )
+        for start in range(PART_SIZE, size, PART_SIZE)
+    ]
+    return first + b"".join(part.result()[0] for part in parts)
+
+
+def export(
+    client: upload.Client,
+    items: List[Item],
+    output: archive.Output,
+    progress: Progress,
+    jobs: int = 8,
+) -> None:
+    """
+    Download the files of an export, and write them in order.
+
+    At most a few files per job are in memory, no matter how many files
+    there are. Files that the progress has already are skipped. Parts of
+    large files are only bound by the network, so as many are downloaded
+    at once as the controller of the client allows.
+    """
+    todo = [item for item in items if not progress.is_done(item)]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=client.controller.max_limit
+    ) as parts_executor, contextlib.closing(
+        work.in_order(
+            lambda item: download(client, item.object_name, parts_executor),
+            todo,
+            jobs,
+        )
+    ) as downloads:
+        for item, future in downloads:
+            data = future.result()
+            output.write_bytes(item.path, data)
+            progress.append(entry_of(item, data), checkpoint(output))
+            print(f"{item.path} ({len(data) // 1024} KiB)", file=sys.stderr)
+
+    entries = [progress.entries[item.path] for item in items]
+    output.write_text(MANIFEST_NAME, json.dumps({"files": entries}, indent=2))
+    output.write_text(
+        CHECKSUMS_NAME,
+        "".join(f"{entry['sha256']}  {entry['path']}\n" for entry in entries),
+    )
+
+
+def entry_of(item: Item, data: bytes) -> Dict[str, Any]:
+    return {
+        "path": item.path,
+        "object_name": item.object_name,
+        "album": item.album.name_display,
+        "image": str(item.image.remote_uuid),
+        "size": item.size.name,
+        "bytes": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def checkpoint(output: archive.Output) -> int:
+    """
+    Make sure the files so far are on disk. Returns where a tar archive
+    ends after them.
+    """
+    output.sync()
+    if isinstance(output, archive.TarOutput):
+        return output.offset
+    return 0
@@ -1,86 +1,143 @@
 import jinja2
-import shutil
+import json
 
 from pathlib import Path
+from typing import Any, Dict
 
+import pxl.archive as archive
 import pxl.state as state
 
 
 def build(
     overview: state.Overview,
-    output_dir: Path,
+    output: archive.Output,
     template_dir: Path,
+    cache_dir: Path,
     bucket_puburl: str,
     public_image_url: str,
 ) -> None:
     """Build a static site based on the state."""
 
-    index_template = load_template(template_dir / "index.html.j2")
-    album_template = load_template(template_dir / "album.html.j2")
-    photo_template = load_template(template_dir / "photo.html.j2")
+    env = environment(template_dir, cache_dir)
+    index_template = env.get_template("index.html.j2")
+    album_template = env.get_template("album.html.j2")
+    photo_template = env.get_template("photo.html.j2")
 
-    clear_directory(output_dir)
-    output_dir.mkdir(exist_ok=True)
-
-    shutil.copytree(template_dir / "css", output_dir / "css")
-    shutil.copytree(template_dir / "js", output_dir / "js")
-    shutil.copy(template_dir / "404.html", output_dir / "404.html")
+    output.copy_tree(template_dir / "css", "css")
+    output.copy_tree(template_dir / "js", "js")
+    output.write_bytes("404.html", (template_dir / "404.html").read_bytes())
 
     img_baseurl = public_image_url or bucket_puburl
 
-    with (output_dir / "index.html").open("w+") as f:
-        index_template.stream(overview=overview, img_baseurl=img_baseurl).dump(f)
+    # From the summaries, which have the covers of the albums.
+    output.write_text(
+        "index.html", index_template.render(overview=overview, img_baseurl=img_baseurl)
+    )
 
     for album in overview.albums:
-        album_dir = output_dir / album.name_nav
-        album_dir.mkdir()
-
-        with (album_dir / "index.html").open("w+") as f:
-            album_template.stream(album=album, img_baseurl=img_baseurl).dump(f)
+        # Every image is on the album page, on its own page and on the
+        # pages of its neighbours. Compute its URLs only once.
+        urls = [image_urls(album, image, img_baseurl) for image in album.images]
+        # Images that are not on a sprite sheet show their own thumbnail.
+        styles = tile_styles(album, img_baseurl)
+        tiles = [styles.get(str(image.remote_uuid)) for image in album.images]
+
+        output.write_text(
+            f"{album.name_nav}/index.html",
+            album_template.render(album=album, images=zip(album.images, urls, tiles)),
+        )
+        output.write_text(
+            f"{album.name_nav}/manifest.json",
+            json.dumps(album_manifest(album, img_baseurl), separators=(",", ":")),
+        )
 
         for i, image in enumerate(album.images):
-            image_dir = album_dir / str(image.remote_uuid)
-            image_dir.mkdir()
-
             title = f"{album.name_display} - {i} / {len(album.images) - 1}"
 
-            with (image_dir / "index.html").open("w+") as f:
-                img_prev = album.images[i - 1] if i - 1 >= 0 else None
-                img_next = album.images[i + 1] if i + 1 < len(album.images) else None
-
-                photo_template.stream(
-                    img=image,
-                    img_prev=img_prev,
-                    img_next=img_next,
-                    img_baseurl=img_baseurl,
+            output.write_text(
+                f"{album.name_nav}/{image.remote_uuid}/index.html",
+                photo_template.render(
+                    img=urls[i],
+                    img_prev=urls[i - 1] if i - 1 >= 0 else None,
+                    img_next=urls[i + 1] if i + 1 < len(album.images) else None,
                     album_name=album.name_nav,
                     title=title,
-                ).dump(f)
-
-
-def load_template(template_file: Path) -> jinja2.Template:
-    """Load a jinja template from a file.
-
-    There isn't a method in the standard API that does this, so
-    we roll it ourselves."""
-
-    with template_file.open() as f:
-        return jinja2.Template(f.read())
-
-
-def clear_directory(dir_path: Path) -> None:
-    """Remove all directory contents, except for the directory itself.
-
-    This is useful so the inode number for the directory doesn't get removed
-    and HTTP servers and the like keep on working."""
-
-    if not dir_path.exists():
-        return
-
-    assert dir_path.is_dir()
-
-    for entry in dir_path.iterdir():
-        if entry.is_dir():
-            shutil.rmtree(entry)
-        else:
-            entry.unlink()
+                ),
+            )
+
+
+def environment(template_dir: Path, cache_dir: Path) -> jinja2.Environment:
+    """
+    Create the Jinja environment for the templates in `template_dir`.
+
+    Compiled templates are cached in `cache_dir`, so we only compile the
+    templates again when they changed.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(template_dir)),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(str(cache_dir)),
+        # Templates don't change during a build.
+        auto_reload=False,
+    )
+
+
+def image_urls(
+    album: state.Album, image: state.Image, img_baseurl: str
+) -> Dict[str, str]:
+    """
+    The URLs of all sizes of an image, and of its page.
+    """
+    urls = {
+        size.name: f"{img_baseurl}/{image.get_name(size.name)}.jpg"
+        for size in state.Size
+    }
+    urls["page"] = f"/{album.name_nav}/{image.remote_uuid}"
+    return urls
+
+
+def tile_styles(album: state.Album, img_baseurl: str) -> Dict[str, Dict[str, str]]:
+    """
+    CSS to show the tile of every image that is on a sheet, by the UUID
+    of the image. The sheet is scaled so one tile fills the element.
+    """
+    styles = {}
+    for sheet in album.sprites:
+        url = f"{img_baseurl}/{sheet.name}.jpg"
+        size = f"{sheet.columns * 100}% {sheet.rows * 100}%"
+        for i, image_uuid in enumerate(sheet.images):
+            row, column = divmod(i, sheet.columns)
+            # Percentages in background-position align that fraction of
+            # the image with the same fraction of the element.
+            x = column * 100 / (sheet.columns - 1) if sheet.columns > 1 else 0
+            y = row * 100 / (sheet.rows - 1) if sheet.rows > 1 else 0
+            styles[str(image_uuid)] = {
+                "url": url,
+                "size": size,
+                "position": f"{x:.4g}% {y:.4g}%",
+            }
+
+    return styles
+
+
+def album_manifest(album: state.Album, img_baseurl: str) -> Dict[str, Any]:
+    """
+    A compact description of an album, for the photo viewer in photo.js.
+
+    With it, the viewer can show the other images of the album without
+    loading their pages. The images are in album order.
+    """
+    return {
+        "name": album.name_display,
+        "base": img_baseurl,
+        "images": [
+            {
+                "id": str(image.remote_uuid),
+                "display": f"{image.get_name('display_w_1600')}.jpg",
+                "original": f"{image.get_name('original')}.jpg",
+                "width": image.width,
+                "height": image.height,
+            }
+            for image in album.images
+        ],
+    }
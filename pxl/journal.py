@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import threading
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import pxl.config as config
+import pxl.state as state
+import pxl.work as work
+
+JOURNAL_DIR = Path.home() / ".local" / "share" / "pxl" / "journal"
+
+
+@dataclass
+class Entry:
+    image: state.Image
+    uploaded: Set[state.Size]
+    committed: bool
+
+    def is_uploaded(self) -> bool:
+        return all(size in self.uploaded for size in self.image.stored_sizes)
+
+
+@dataclass
+class Journal:
+    """
+    Write-ahead log of an upload of a local directory.
+
+    Every step of the upload of an image is appended to a local file and
+    synced to disk before the next step starts: the image is processed
+    (which picks its UUID), every size of it is uploaded, and the state
+    containing it is saved. When pxl crashes or loses its connection,
+    the journal tells which work is already done, so a resumed upload
+    only has to do the rest.
+    """
+
+    log: work.Log
+    album: state.Album
+    entries: Dict[str, Entry]
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def create(cls, cfg: config.Config, dir_path: Path, album: state.Album) -> Journal:
+        # The images already in the album are in the remote state, so
+        # we only need to remember which album we're uploading to.
+        album = dataclasses.replace(album, images=[])
+        journal = cls(
+            log=work.Log(journal_path(cfg, dir_path)), album=album, entries={}
+        )
+        journal.log.clear()
+        journal.append({"event": "begin", "album": album.to_json()})
+        return journal
+
+    @classmethod
+    def load(cls, cfg: config.Config, dir_path: Path) -> Optional[Journal]:
+        log = work.Log(journal_path(cfg, dir_path))
+        records = log.read()
+        if not records or records[0].get("event") != "begin":
+            return None
+
+        album = state.Album.from_json(records[0]["album"])
+        if album is None:
+            return None
+
+        journal = cls(log=log, album=album, entries={})
+        for record in records[1:]:
+            journal.replay(record)
+
+        return journal
+
+    def replay(self, record: Dict[str, Any]) -> None:
+        event = record.get("event")
+        if event == "processed":
+            image = state.Image.from_json(record["image"])
+            if image is not None:
+                self.entries[record["source"]] = Entry(
+                    image=image, uploaded=set(), committed=False
+                )
+        elif event == "uploaded":
+            entry = self.entries.get(record["source"])
+            if entry is not None:
+                entry.uploaded.add(state.Size[record["size"]])
+        elif event == "committed":
+            for source in record["sources"]:
+                if source in self.entries:
+                    self.entries[source].committed = True
+
+    def append(self, record: Dict[str, Any]) -> None:
+        with self.lock:
+            self.log.append(record)
+            self.replay(record)
+
+    def get(self, source: Path) -> Optional[Entry]:
+        return self.entries.get(source.name)
+
+    def is_committed(self, source: Path, album: state.Album) -> bool:
+        """
+        Check whether the image is in the saved state already.
+
+        We might have crashed after saving the state, but before writing
+        that down in the journal. So we also look in the album itself.
+        """
+        entry = self.get(source)
+        if entry is None:
+            return False
+
+        remote_uuids = {image.remote_uuid for image in album.images}
+        return entry.committed or entry.image.remote_uuid in remote_uuids
+
+    def processed(self, source: Path, image: state.Image) -> None:
+        self.append(
+            {"event": "processed", "source": source.name, "image": image.to_json()}
+        )
+
+    def uploaded(self, source: Path, size: state.Size) -> None:
+        self.append({"event": "uploaded", "source": source.name, "size": size.name})
+
+    def committed(self, sources: List[Path]) -> None:
+        self.append(
+            {"event": "committed", "sources": [source.name for source in sources]}
+        )
+
+    def remove(self) -> None:
+        self.log.remove()
+
+
+def journal_path(cfg: config.Config, dir_path: Path) -> Path:
+    """
+    The journal belongs to a directory uploaded to a bucket. Both are in
+    the name, so uploads of different directories don't get mixed up.
+    """
+    key = f"{cfg.s3_endpoint}/{cfg.s3_bucket}/{dir_path.resolve()}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return JOURNAL_DIR / f"{digest}.jsonl"
@@ -0,0 +1,365 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import dataclasses
+import hashlib
+import io
+import json
+import sys
+import uuid
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Counter, Dict, Iterator, List, Optional, Set, Tuple
+
+from PIL import Image  # type: ignore
+
+import pxl.compress as compress
+import pxl.config as config
+import pxl.remote as remote
+import pxl.state as state
+import pxl.upload as upload
+import pxl.work as work
+
+PROGRESS_DIR = Path.home() / ".local" / "share" / "pxl" / "regenerate"
+
+
+@dataclass
+class Result:
+    # The image with its new sizes, or None when it failed.
+    image: Optional[state.Image]
+    # Whether the image changed, so its album needs to be saved.
+    changed: bool = False
+    uploaded: int = 0
+    unchanged: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class Stats:
+    images: int = 0
+    uploaded: int = 0
+    unchanged: int = 0
+    # Objects of sizes that became aliases of the original.
+    deleted: int = 0
+    failed: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.images} images, {self.uploaded} sizes uploaded,"
+            f" {self.unchanged} unchanged, {self.deleted} deleted,"
+            f" {self.failed} images failed"
+        )
+
+
+@dataclass
+class Progress:
+    """
+    The images that were regenerated already, with a record in a log for
+    every image, and for every time the state was saved.
+
+    Images that are done but not saved yet are kept here, so a resumed
+    run saves them first. Only their UUIDs are kept for images that are
+    saved, so the progress of a large library stays small.
+    """
+
+    # Not synced to disk: when the last records get lost, those images
+    # are only regenerated again.
+    log: work.Log
+    done: Set[str] = field(default_factory=set)
+    # Images that are not saved yet, by album and UUID.
+    unsaved: Dict[str, Dict[uuid.UUID, state.Image]] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Path) -> Progress:
+        progress = cls(log=work.Log(path, sync=False))
+        for record in progress.log.read():
+            progress.replay(record)
+
+        return progress
+
+    def replay(self, record: Dict[str, Any]) -> None:
+        if record["event"] == "unchanged":
+            self.done.add(record["image"])
+        elif record["event"] == "done":
+            image = state.Image.from_json(record["image"])
+            if image is not None:
+                self.done.add(image.remote_uuid.hex)
+                images = self.unsaved.setdefault(record["album"], {})
+                images[image.remote_uuid] = image
+        elif record["event"] == "saved":
+            for album_name in record["albums"]:
+                self.unsaved.pop(album_name, None)
+
+    def append(self, record: Dict[str, Any]) -> None:
+        self.log.append(record)
+        self.replay(record)
+
+    def is_done(self, image: state.Image) -> bool:
+        return image.remote_uuid.hex in self.done
+
+    def image_done(self, album_name: str, image: state.Image, changed: bool) -> None:
+        if changed:
+            record = {"event": "done", "album": album_name, "image": image.to_json()}
+        else:
+            record = {"event": "unchanged", "image": image.remote_uuid.hex}
+        self.append(record)
+
+    def saved(self, album_names: List[str]) -> None:
+        self.append({"event": "saved", "albums": album_names})
+
+    def remove(self) -> None:
+        self.log.remove()
+
+
+def progress_path(cfg: config.Config, sizes: List[state.Size]) -> Path:
+    """
+    The progress belongs to a bucket, and to the sizes and the settings
+    they are encoded with. When those change, everything is done again.
+    """
+    profiles = compress.profiles_from_json(cfg.encoding_profiles)
+    settings = [
+        [size.name, dataclasses.asdict(profiles[size])]
+        for size in sorted(sizes, key=lambda size: size.name)
+    ]
+    key = f"{cfg.s3_endpoint}/{cfg.s3_bucket}/{json.dumps(settings, sort_keys=True)}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return PROGRESS_DIR / f"{digest}.jsonl"
+
+
+def needs_work(
+    image: state.Image, sizes: List[state.Size], progress: Progress, only_missing: bool
+) -> bool:
+    if progress.is_done(image):
+        return False
+    if only_missing:
+        return any(size not in image.available_sizes for size in sizes)
+    return True
+
+
+def regenerate_image(
+    client: upload.Client,
+    image: state.Image,
+    sizes: List[state.Size],
+    profiles: Dict[state.Size, compress.EncodingProfile],
+) -> Result:
+    """
+    Make `sizes` of an image again from its original in the bucket.
+
+    Sizes are only uploaded when their bytes changed, which we can tell
+    from the ETag of the object that is there. Like `compress_image`,
+    sizes that are not smaller than the original become aliases of it.
+    Their old objects are deleted once the state is saved, see `run`.
+    """
+    original_name = image.get_name(state.Size.original.name) + ".jpg"
+    try:
+        data = upload.get_bytes(client, original_name)
+    except client.boto.exceptions.NoSuchKey:
+        return Result(image=None, error=f"{original_name} does not exist")
+
+    try:
+        with Image.open(io.BytesIO(data)) as opened:
+            original = compress.orient_exif(opened).convert("RGB")
+    except OSError as e:
+        return Result(image=None, error=f"{original_name} can't be read: {e}")
+
+    # Only the pixels are needed from here on.
+    del data
+    width, height = original.size
+    uploaded = unchanged = 0
+    available_sizes = list(image.available_sizes)
+    aliases = dict(image.aliases)
+    thumbnail = None
+    for size in sizes:
+        if size not in available_sizes:
+            available_sizes.append(size)
+
+        if size.max_width >= width:
+            aliases[size] = state.Size.original
+            continue
+
+        scaled = compress.scale(original, size)
+        if size == state.Size.thumbnail_w_400:
+            thumbnail = scaled
+        encoded, _ = compress.encode(scaled, profiles[size])
+
+        object_name = f"{image.remote_uuid}{size.path_suffix}.jpg"
+        etag = None
+        if size in image.stored_sizes:
+            etag = upload.get_etag(client, object_name)
+
+        if etag == hashlib.md5(encoded).hexdigest():
+            unchanged += 1
+        else:
+            upload.public_bytes(client, encoded, object_name, attachment=True)
+            uploaded += 1
+        aliases.pop(size, None)
+
+    dhash = image.dhash
+    if dhash is None:
+        # Like `compress_image`, from the thumbnail when there is one.
+        if thumbnail is None and width > state.Size.thumbnail_w_400.max_width:
+            thumbnail = compress.scale(original, state.Size.thumbnail_w_400)
+        dhash = compress.dhash(original if thumbnail is None else thumbnail)
+
+    new_image = dataclasses.replace(
+        image,
+        available_sizes=available_sizes,
+        aliases=aliases,
+        dhash=dhash,
+        width=width,
+        height=height,
+    )
+    return Result(
+        image=new_image,
+        changed=new_image != image,
+        uploaded=uploaded,
+        unchanged=unchanged,
+    )
+
+
+def with_images(
+    album: state.Album, images: Dict[uuid.UUID, state.Image]
+) -> state.Album:
+    return dataclasses.replace(
+        album,
+        images=[images.get(image.remote_uuid, image) for image in album.images],
+    )
+
+
+def obsolete_objects(
+    album: state.Album, images: Dict[uuid.UUID, state.Image]
+) -> List[str]:
+    """
+    The objects of sizes that are stored for images in `album`, but are
+    aliases in their new versions in `images`.
+    """
+    object_names: List[str] = []
+    for image in album.images:
+        new_image = images.get(image.remote_uuid)
+        if new_image is None:
+            continue
+
+        object_names.extend(
+            f"{image.remote_uuid}{size.path_suffix}.jpg"
+            for size in image.stored_sizes
+            if size not in new_image.stored_sizes
+        )
+
+    return object_names
+
+
+def fetch_album(client: upload.Client, summary: state.AlbumSummary) -> state.Album:
+    # One at a time, so only the albums we work on are in memory.
+    [album] = remote.fetch_albums(client, [summary], jobs=1)
+    return album
+
+
+def run(
+    client: upload.Client,
+    summaries: List[state.AlbumSummary],
+    sizes: List[state.Size],
+    progress: Progress,
+    only_missing: bool = False,
+    jobs: int = 8,
+    commit_every: int = 500,
+) -> Stats:
+    """
+    Regenerate `sizes` of the images of some albums, and save the albums
+    with their new sizes after every `commit_every` images.
+
+    All images go through the same pool, in album order. Only a few
+    images per job are in flight, and albums are fetched when we get to
+    them and forgotten when they are saved, so memory stays bounded no
+    matter how large the library is.
+    """
+    profiles = compress.profiles_from_json(client.cfg.encoding_profiles)
+    stats = Stats()
+    by_name = {summary.name_display: summary for summary in summaries}
+
+    # Albums that have images in flight or changes that are not saved.
+    albums: Dict[str, state.Album] = {}
+    in_flight: Counter[str] = collections.Counter()
+    unsaved: Dict[str, Dict[uuid.UUID, state.Image]] = {}
+    submitted: Set[str] = set()
+
+    def save() -> None:
+        if not unsaved:
+            return
+
+        names = list(unsaved.keys())
+        obsolete = []
+        for name in names:
+            images = unsaved.pop(name)
+            obsolete.extend(obsolete_objects(albums[name], images))
+            albums[name] = with_images(albums[name], images)
+        remote.save(client, [albums[name] for name in names])
+
+        # Only now, so the saved state never refers to a deleted object.
+        for object_name in obsolete:
+            upload.delete_object(client, object_name)
+        stats.deleted += len(obsolete)
+        progress.saved(names)
+        print(f"Saved {', '.join(names)} ({stats.summary()}).", file=sys.stderr)
+        for name in names:
+            forget(name)
+
+    def forget(name: str) -> None:
+        if name in submitted and not in_flight[name] and name not in unsaved:
+            albums.pop(name, None)
+
+    # Images that were done before, but not saved, are saved first.
+    for name, images in list(progress.unsaved.items()):
+        if name in by_name:
+            albums[name] = fetch_album(client, by_name[name])
+            unsaved[name] = dict(images)
+            submitted.add(name)
+    save()
+
+    def todo() -> Iterator[Tuple[str, state.Image]]:
+        for summary in summaries:
+            name = summary.name_display
+            albums[name] = fetch_album(client, summary)
+            for image in albums[name].images:
+                if needs_work(image, sizes, progress, only_missing):
+                    # Images are taken from here when they are submitted.
+                    in_flight[name] += 1
+                    yield name, image
+            submitted.add(name)
+            forget(name)
+
+    try:
+        with contextlib.closing(
+            work.in_order(
+                lambda task: regenerate_image(client, task[1], sizes, profiles),
+                todo(),
+                jobs,
+            )
+        ) as results:
+            for (name, _), future in results:
+                result = future.result()
+                in_flight[name] -= 1
+
+                if result.image is None:
+                    stats.failed += 1
+                    print(
+                        f"Skipping an image of {name}: {result.error}", file=sys.stderr
+                    )
+                else:
+                    stats.images += 1
+                    stats.uploaded += result.uploaded
+                    stats.unchanged += result.unchanged
+                    progress.image_done(name, result.image, result.changed)
+                    if result.changed:
+                        images = unsaved.setdefault(name, {})
+                        images[result.image.remote_uuid] = result.image
+
+                if sum(len(images) for images in unsaved.values()) >= commit_every:
+                    save()
+                forget(name)
+    finally:
+        # Even when something failed, save the images that are done.
+        save()
+
+    return stats
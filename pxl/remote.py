@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import json
+
+from typing import Any, Dict, List, Sequence
+
+import pxl.state as state
+import pxl.upload as upload
+
+# The state is split in an index, with a summary of every album, and an
+# object for every album. Commands only fetch and save the albums they
+# need, so the size of the library doesn't matter much.
+INDEX_NAME = "state/index.json"
+INDEX_VERSION = 2
+
+# Before that, all albums were in one object.
+LEGACY_NAME = "state.json"
+LEGACY_BACKUP_NAME = "state/legacy-state.json"
+
+
+def album_object_name(name_nav: str) -> str:
+    return f"state/albums/{name_nav}.json"
+
+
+def load(client: upload.Client, jobs: int = 16) -> state.Overview:
+    """
+    Load the index of the state. Albums are fetched when they are needed.
+
+    When there is only a state in the old format, it is migrated first.
+    Raises NoSuchKey when there is no state at all.
+    """
+    try:
+        index_json = upload.get_json(client, INDEX_NAME)
+    except client.boto.exceptions.NoSuchKey:
+        return migrate(client, jobs)
+
+    overview = state.Overview.from_index_json(
+        index_json, functools.partial(fetch_albums, client, jobs=jobs)
+    )
+    assert overview is not None, "Expected state to be valid"
+    return overview
+
+
+def fetch_albums(
+    client: upload.Client, summaries: List[state.AlbumSummary], jobs: int
+) -> List[state.Album]:
+    def fetch(summary: state.AlbumSummary) -> state.Album:
+        album_json = upload.get_json(client, album_object_name(summary.name_nav))
+        album = state.Album.from_json(album_json)
+        assert album is not None, f"Expected {summary.name_nav} to be valid"
+        return album
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(fetch, summaries))
+
+
+def save(
+    client: upload.Client,
+    albums: List[state.Album],
+    removed: Sequence[state.Album] = (),
+) -> None:
+    """
+    Save changed albums, and remove albums, in the remote state.
+
+    New album objects are written before the index, and the objects of
+    removed or renamed albums are deleted after it, so the index never
+    refers to an album that isn't there. The index is read again before
+    writing it, so albums that another pxl changed in the meantime keep
+    their changes.
+    """
+    for album in albums:
+        put_album(client, album)
+
+    try:
+        index_json = upload.get_json(client, INDEX_NAME)
+        summaries = state.filter_optionals(
+            [state.AlbumSummary.from_json(summary) for summary in index_json["albums"]]
+        )
+    except client.boto.exceptions.NoSuchKey:
+        summaries = []
+
+    # Albums keep their place in the index, new albums go at the end.
+    saved = {album.name_display: state.AlbumSummary.of(album) for album in albums}
+    removed_names = {album.name_display for album in removed} - saved.keys()
+    summaries = [
+        saved.pop(summary.name_display, summary)
+        for summary in summaries
+        if summary.name_display not in removed_names
+    ]
+    summaries.extend(saved.values())
+    upload.private_json(client, json.dumps(index_json_of(summaries)), INDEX_NAME)
+
+    saved_nav = {album.name_nav for album in albums}
+    for album in removed:
+        if album.name_nav not in saved_nav:
+            upload.delete_object(client, album_object_name(album.name_nav))
+
+
+def put_album(client: upload.Client, album: state.Album) -> None:
+    upload.private_json(
+        client, json.dumps(album.to_json()), album_object_name(album.name_nav)
+    )
+
+
+def index_json_of(summaries: List[state.AlbumSummary]) -> Dict[str, Any]:
+    return {
+        "version": INDEX_VERSION,
+        "albums": [summary.to_json() for summary in summaries],
+    }
+
+
+def migrate(client: upload.Client, jobs: int) -> state.Overview:
+    """
+    Split a state in the old format into an index and album objects.
+
+    The old state is kept as a backup, but removed from its old place, so
+    that nothing keeps on using it.
+    """
+    legacy_json = upload.get_json(client, LEGACY_NAME)
+    overview = state.Overview.from_json(legacy_json)
+    assert overview is not None, "Expected state to be valid"
+
+    print(f"Moving the state to one object per album ({len(overview.albums)})...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(functools.partial(put_album, client), overview.albums))
+
+    upload.private_json(
+        client, json.dumps(index_json_of(overview.summaries)), INDEX_NAME
+    )
+    upload.private_json(client, json.dumps(legacy_json), LEGACY_BACKUP_NAME)
+    upload.delete_object(client, LEGACY_NAME)
+    return overview
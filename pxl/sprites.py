@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses
+import hashlib
+import io
+
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageOps  # type: ignore
+
+import pxl.compress as compress
+import pxl.state as state
+import pxl.upload as upload
+
+# The album page shows thumbnails in cells that are wider than they are
+# high. Tiles are cropped to this size, like `object-fit: cover` does.
+TILE_WIDTH = 400
+TILE_HEIGHT = 300
+
+# Tiles per sheet. With more, a sheet takes longer before it shows
+# anything, with less we need more requests.
+COLUMNS = 6
+ROWS = 6
+
+
+def sheet_name(album: state.Album, images: List[state.Image]) -> str:
+    """
+    The object name of the sheet with the thumbnails of `images`.
+
+    The name changes when the images or the layout change, so a sheet
+    never has to be replaced, and browsers may cache it forever.
+    """
+    layout = f"{TILE_WIDTH}x{TILE_HEIGHT}/{COLUMNS}"
+    digest = hashlib.sha1(layout.encode("ascii"))
+    for image in images:
+        digest.update(image.remote_uuid.bytes)
+    return f"sprites/{album.name_nav}/{digest.hexdigest()[:16]}"
+
+
+def plan(album: state.Album) -> List[Tuple[str, List[state.Image]]]:
+    """The sheets an album should have, with the images on them."""
+    per_sheet = COLUMNS * ROWS
+    chunks = [
+        album.images[start : start + per_sheet]
+        for start in range(0, len(album.images), per_sheet)
+    ]
+    return [(sheet_name(album, images), images) for images in chunks]
+
+
+def update(
+    client: upload.Client, album: state.Album, jobs: int = 8
+) -> Optional[state.Album]:
+    """
+    Make the sheets of an album that it doesn't have yet, and remove the
+    sheets it no longer needs. Returns the album with its new sheets, or
+    None when its sheets were up to date.
+
+    Sheets hold a fixed range of the images, so adding images to the end
+    of an album only makes its last sheet again.
+    """
+    existing = {sheet.name: sheet for sheet in album.sprites}
+    planned = plan(album)
+    if [name for name, _ in planned] == [sheet.name for sheet in album.sprites]:
+        return None
+
+    profile = compress.profiles_from_json(client.cfg.encoding_profiles)[
+        state.Size.thumbnail_w_400
+    ]
+
+    sheets = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for name, images in planned:
+            sheet = existing.get(name)
+            if sheet is None:
+                tiles = list(
+                    executor.map(lambda image: fetch_tile(client, image), images)
+                )
+                sheet, data = render(name, images, tiles, profile)
+                upload.public_bytes(client, data, f"{name}.jpg", immutable=True)
+            sheets.append(sheet)
+
+    used = {sheet.name for sheet in sheets}
+    for name in existing.keys() - used:
+        upload.delete_object(client, f"{name}.jpg")
+
+    return dataclasses.replace(album, sprites=sheets)
+
+
+def fetch_tile(client: upload.Client, image: state.Image) -> Image.Image:
+    data = upload.get_bytes(client, image.get_name("thumbnail_w_400") + ".jpg")
+    with Image.open(io.BytesIO(data)) as thumbnail:
+        # Small images use their original as thumbnail, which may still
+        # need to be rotated.
+        thumbnail = compress.orient_exif(thumbnail).convert("RGB")
+        return ImageOps.fit(thumbnail, (TILE_WIDTH, TILE_HEIGHT), Image.LANCZOS)
+
+
+def render(
+    name: str,
+    images: List[state.Image],
+    tiles: List[Image.Image],
+    profile: compress.EncodingProfile,
+) -> Tuple[state.SpriteSheet, bytes]:
+    columns = min(COLUMNS, len(tiles))
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * TILE_WIDTH, rows * TILE_HEIGHT))
+    for i, tile in enumerate(tiles):
+        row, column = divmod(i, columns)
+        sheet.paste(tile, (column * TILE_WIDTH, row * TILE_HEIGHT))
+
+    data, _ = compress.encode(sheet, profile)
+    sprite_sheet = state.SpriteSheet(
+        name=name,
+        columns=columns,
+        rows=rows,
+        images=[image.remote_uuid for image in images],
+    )
+    return sprite_sheet, data
@@ -2,11 +2,12 @@ from __future__ import annotations
 
 import datetime
 import locale
+import re
 import uuid
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import Any, Dict, List, Optional, Tuple, TypeVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
 
 class Size(Enum):
@@ -35,34 +36,97 @@ class Size(Enum):
         return size_switch[self]
 
 
+# Names of the objects in the bucket for every size of an image, like
+# "<uuid>_w_400.jpg". See `Image.object_names`.
+OBJECT_NAME = re.compile(r"^[0-9a-f-]{36}_(o|w_\d+)\.jpg$")
+
+
 @dataclass
 class Image:
     # The UUID derives the remote filename for the original, detail
     # and thumbnail versions of the image.
     remote_uuid: uuid.UUID
     available_sizes: List[Size]
+    # Perceptual hash of the image, to find near-duplicates. See
+    # `compress.dhash`. Images uploaded before we had this don't have it.
+    dhash: Optional[int] = None
+    # When uploaded as a near-duplicate of another image, that image.
+    duplicate_of: Optional[uuid.UUID] = None
+    # Dimensions of the original, after rotating it upright.
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # From the EXIF metadata, when the camera recorded it.
+    captured: Optional[datetime.datetime] = None
+    camera: Optional[str] = None
+    # Sizes that are served by the object of another size, because the
+    # image is not wider than them. These are in `available_sizes` too,
+    # but have no object of their own.
+    aliases: Dict[Size, Size] = field(default_factory=dict)
 
     @classmethod
     def from_json(cls, json: Dict[str, Any]) -> Optional[Image]:
         try:
             available_sizes = json.get("available_sizes", ["original"])
             sizes_parsed = list(map(lambda x: Size[x], available_sizes))
+            dhash = json.get("dhash")
+            duplicate_of = json.get("duplicate_of")
+            captured = json.get("captured")
+            if captured is not None:
+                captured = datetime.datetime.fromisoformat(captured)
+            aliases = {
+                Size[alias]: Size[target]
+                for alias, target in json.get("aliases", {}).items()
+            }
 
             return cls(
-                remote_uuid=uuid.UUID(json["remote_uuid"]), available_sizes=sizes_parsed
+                remote_uuid=uuid.UUID(json["remote_uuid"]),
+                available_sizes=sizes_parsed,
+                dhash=int(dhash, 16) if dhash is not None else None,
+                duplicate_of=uuid.UUID(duplicate_of) if duplicate_of else None,
+                width=json.get("width"),
+                height=json.get("height"),
+                captured=captured,
+                camera=json.get("camera"),
+                aliases=aliases,
             )
         except KeyError:
             return None
 
     def to_json(self) -> Dict[str, Any]:
-        return {
+        result: Dict[str, Any] = {
             "remote_uuid": self.remote_uuid.hex,
             "available_sizes": list(map(lambda x: x.name, self.available_sizes)),
         }
+        if self.dhash is not None:
+            result["dhash"] = f"{self.dhash:016x}"
+        if self.duplicate_of is not None:
+            result["duplicate_of"] = self.duplicate_of.hex
+        if self.width is not None and self.height is not None:
+            result["width"] = self.width
+            result["height"] = self.height
+        if self.captured is not None:
+            result["captured"] = self.captured.isoformat(timespec="seconds")
+        if self.camera is not None:
+            result["camera"] = self.camera
+        if self.aliases:
+            result["aliases"] = {
+                alias.name: target.name for alias, target in self.aliases.items()
+            }
+        return result
+
+    @property
+    def stored_sizes(self) -> List[Size]:
+        """The sizes that have an object of their own in the bucket."""
+        return [size for size in self.available_sizes if size not in self.aliases]
+
+    def object_names(self) -> List[str]:
+        """The names of the objects of this image, like `get_name`."""
+        return [f"{self.remote_uuid}{size.path_suffix}" for size in self.stored_sizes]
 
     def get_name(self, size_name: str) -> str:
         try:
             size = Size[size_name]
+            size = self.aliases.get(size, size)
             if size in self.available_sizes:
                 return f"{self.remote_uuid}{size.path_suffix}"
             else:
@@ -77,12 +141,46 @@ class Image:
             return Size.original.path_suffix
 
 
+@dataclass
+class SpriteSheet:
+    """
+    One image with the thumbnails of several images of an album, in rows
+    of `columns` tiles. See `sprites.py`.
+    """
+
+    # Object name, without the extension.
+    name: str
+    columns: int
+    rows: int
+    # The images in the tiles, row by row.
+    images: List[uuid.UUID]
+
+    @classmethod
+    def from_json(cls, json: Dict[str, Any]) -> SpriteSheet:
+        return cls(
+            name=json["name"],
+            columns=json["columns"],
+            rows=json["rows"],
+            images=[uuid.UUID(image) for image in json["images"]],
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "columns": self.columns,
+            "rows": self.rows,
+            "images": [image.hex for image in self.images],
+        }
+
+
 @dataclass
 class Album:
     created: datetime.datetime
     images: List[Image]
     name_display: str
     name_nav: str
+    # Sheets with the thumbnails of the images, when they were made.
+    sprites: List[SpriteSheet] = field(default_factory=list)
 
     @property
     def created_human(self) -> str:
@@ -114,17 +212,23 @@ class Album:
                 name_display=name_display,
                 name_nav=name_nav,
                 created=datetime.datetime.fromisoformat(json["created"]),
+                sprites=[
+                    SpriteSheet.from_json(sheet) for sheet in json.get("sprites", [])
+                ],
             )
         except KeyError:
             return None
 
     def to_json(self) -> Dict[str, Any]:
-        return {
+        result = {
             "images": list(map(lambda image: image.to_json(), self.images)),
             "name_nav": self.name_nav,
             "name_display": self.name_display,
             "created": self.created.isoformat(timespec="seconds"),
         }
+        if self.sprites:
+            result["sprites"] = [sheet.to_json() for sheet in self.sprites]
+        return result
 
     def add_image(self, image: Image) -> Album:
         return Album(
@@ -132,60 +236,171 @@ class Album:
             name_display=self.name_display,
             created=self.created,
             name_nav=self.name_nav,
+            sprites=self.sprites,
         )
 
 
+@dataclass
+class AlbumSummary:
+    """
+    What the index of the state says about an album. The album itself,
+    with its images, is in an object of its own.
+    """
+
+    name_display: str
+    name_nav: str
+    created: datetime.datetime
+    # The first image, which is the cover of the album on the index page.
+    # Albums without images are left out there.
+    cover: Optional[Image]
+    image_count: int
+
+    @classmethod
+    def of(cls, album: Album) -> AlbumSummary:
+        return cls(
+            name_display=album.name_display,
+            name_nav=album.name_nav,
+            created=album.created,
+            cover=album.images[0] if album.images else None,
+            image_count=len(album.images),
+        )
+
+    @classmethod
+    def from_json(cls, json: Dict[str, Any]) -> Optional[AlbumSummary]:
+        try:
+            cover = json.get("cover")
+            return cls(
+                name_display=json["name_display"],
+                name_nav=json["name_nav"],
+                created=datetime.datetime.fromisoformat(json["created"]),
+                cover=Image.from_json(cover) if cover is not None else None,
+                image_count=json.get("image_count", 0),
+            )
+        except KeyError:
+            return None
+
+    def to_json(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            "name_nav": self.name_nav,
+            "name_display": self.name_display,
+            "created": self.created.isoformat(timespec="seconds"),
+            "image_count": self.image_count,
+        }
+        if self.cover is not None:
+            result["cover"] = self.cover.to_json()
+        return result
+
+
+# Fetches the albums of some summaries, see `Overview.fetch`.
+Fetch = Callable[[List[AlbumSummary]], List[Album]]
+
+
 @dataclass
 class Overview:
-    albums: List[Album]
+    """
+    All albums, in the order of the index.
+
+    Albums are loaded when they are needed: `get_album_by_name` loads one
+    album, and `albums` loads all that are not loaded yet, at once. Until
+    then, only their summaries are known.
+    """
+
+    summaries: List[AlbumSummary]
+    # Loaded albums by their display name.
+    loaded: Dict[str, Album] = field(default_factory=dict)
+    fetch: Optional[Fetch] = field(default=None, repr=False, compare=False)
+
+    @property
+    def albums(self) -> List[Album]:
+        self.load(self.summaries)
+        return [self.loaded[summary.name_display] for summary in self.summaries]
+
+    def load(self, summaries: List[AlbumSummary]) -> None:
+        missing = [
+            summary for summary in summaries if summary.name_display not in self.loaded
+        ]
+        if not missing:
+            return
+
+        assert self.fetch is not None, "Expected albums to be loaded"
+        for album in self.fetch(missing):
+            self.loaded[album.name_display] = album
+
+    @classmethod
+    def of(cls, albums: List[Album]) -> Overview:
+        """An overview of albums that are all loaded."""
+        return cls(
+            summaries=[AlbumSummary.of(album) for album in albums],
+            loaded={album.name_display: album for album in albums},
+        )
 
     @classmethod
     def from_json(cls, json: Any) -> Optional[Overview]:
+        """
+        Read the old format of the state, which has all albums in one file.
+        """
         assert isinstance(json, dict)
         try:
             albums = filter_optionals(
                 [Album.from_json(album) for album in json["albums"]]
             )
-            return cls(albums=albums)
+            return cls.of(albums)
         except KeyError:
             return None
 
-    def to_json(self) -> Dict[str, Any]:
-        return {"albums": list(map(lambda album: album.to_json(), self.albums))}
+    @classmethod
+    def from_index_json(cls, json: Any, fetch: Fetch) -> Optional[Overview]:
+        assert isinstance(json, dict)
+        try:
+            summaries = filter_optionals(
+                [AlbumSummary.from_json(summary) for summary in json["albums"]]
+            )
+            return cls(summaries=summaries, fetch=fetch)
+        except KeyError:
+            return None
+
+    def replace(self, summaries: List[AlbumSummary], loaded: List[Album]) -> Overview:
+        names = {summary.name_display for summary in summaries}
+        albums = {name: album for name, album in self.loaded.items() if name in names}
+        albums.update((album.name_display, album) for album in loaded)
+        return Overview(summaries=summaries, loaded=albums, fetch=self.fetch)
 
     def add_or_replace_album(self, new_album: Album) -> Overview:
-        albums = [
-            album
-            for album in self.albums
-            if album.name_display != new_album.name_display
+        summaries = [
+            summary
+            for summary in self.summaries
+            if summary.name_display != new_album.name_display
         ]
-        return Overview(albums=albums + [new_album])
+        return self.replace(summaries + [AlbumSummary.of(new_album)], [new_album])
 
     def get_album_by_name(self, album_name: str) -> Optional[Album]:
-        for album in self.albums:
-            if album.name_display == album_name:
-                return album
+        for summary in self.summaries:
+            if summary.name_display == album_name:
+                self.load([summary])
+                return self.loaded[album_name]
 
         return None
 
     def edit_album(self, old_album: Album, new_album: Album) -> Overview:
-        albums = [
-            album if album.name_display != old_album.name_display else new_album
-            for album in self.albums
+        summaries = [
+            summary
+            if summary.name_display != old_album.name_display
+            else AlbumSummary.of(new_album)
+            for summary in self.summaries
         ]
-        return Overview(albums=albums)
+        return self.replace(summaries, [new_album])
 
     def remove_album(self, album_to_remove: Album) -> Overview:
-        albums = [
-            album
-            for album in self.albums
-            if album.name_display != album_to_remove.name_display
+        summaries = [
+            summary
+            for summary in self.summaries
+            if summary.name_display != album_to_remove.name_display
         ]
-        return Overview(albums=albums)
+        return self.replace(summaries, [])
 
     @classmethod
     def empty(cls) -> Overview:
-        return cls(albums=[])
+        return cls(summaries=[])
 
 
 T = TypeVar("T")
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import random
+import statistics
+import threading
+import time
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Dict, List, Optional, TypeVar
+
+import boto3.exceptions  # type: ignore
+import botocore.exceptions  # type: ignore
+
+T = TypeVar("T")
+
+# Error codes with which S3 compatible services ask us to slow down.
+# Spaces answers 503 SlowDown, others use the names of the AWS APIs.
+THROTTLE_CODES = {
+    "SlowDown",
+    "ServiceUnavailable",
+    "503",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+    "429",
+}
+
+# Errors where the request never got a proper answer.
+CONNECTION_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class Outcome(Enum):
+    # The service is overloaded, retry at a lower concurrency.
+    throttled = "throttled"
+    # Something went wrong on the way, retry.
+    transient = "transient"
+    # Retrying won't help, like a missing object or bad credentials.
+    fatal = "fatal"
+
+
+def classify(error: BaseException) -> Outcome:
+    # `upload_file` turns every ClientError into an S3UploadFailedError,
+    # raised while handling it. The ClientError tells what went wrong.
+    if isinstance(error, boto3.exceptions.S3UploadFailedError):
+        wrapped = error.__cause__ or error.__context__
+        if wrapped is not None:
+            return classify(wrapped)
+
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = str(error.response.get("Error", {}).get("Code", ""))
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        if code in THROTTLE_CODES or status in [429, 503]:
+            return Outcome.throttled
+
+        if status >= 500 or code in ["InternalError", "RequestTimeout"]:
+            return Outcome.transient
+
+        return Outcome.fatal
+
+    # Spaces resets connections instead of answering when it is very
+    # busy, so we treat those as throttling too.
+    if isinstance(error, CONNECTION_ERRORS):
+        return Outcome.throttled
+
+    return Outcome.fatal
+
+
+@dataclass
+class Stats:
+    calls: int = 0
+    retries: int = 0
+    throttled: int = 0
+    failed: int = 0
+    # Seconds per successful attempt.
+    latencies: List[float] = field(default_factory=list)
+
+    def summary(self) -> str:
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p50 = statistics.median(latencies)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            latency = f", latency p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms"
+        else:
+            latency = ""
+
+        return (
+            f"{self.calls} calls, {self.retries} retries"
+            f" ({self.throttled} throttled), {self.failed} failed{latency}"
+        )
+
+
+@dataclass
+class Controller:
+    """
+    Limits the number of concurrent requests to the bucket, and retries
+    requests that fail.
+
+    The limit adapts like TCP congestion control (AIMD): every successful
+    request raises it by 1/limit, so by about one per round of requests,
+    and a throttled request multiplies it by `decrease`. Before the first
+    throttled request, every successful request raises it by one, so it
+    doubles every round (slow start). Only requests that started after
+    the last decrease can decrease it again, so one burst of throttled
+    requests counts once. The limit settles just below the concurrency
+    at which the service starts to throttle.
+
+    The limit only grows while it is what holds requests back. When the
+    caller runs fewer requests at once, their success says nothing
+    about a higher limit, so it stays just above what the caller uses
+    (like congestion window validation in TCP). Callers that are only
+    bound by the network can size their pools to `max_limit`, and leave
+    the limiting to the controller.
+
+    Retries wait with exponential backoff and full jitter, so requests
+    that were throttled together don't come back together. Requests
+    that failed for good are not retried.
+    """
+
+    limit: float = 4.0
+    min_limit: int = 1
+    max_limit: int = 64
+    # Like CUBIC, which wastes less of the link than halving.
+    decrease: float = 0.7
+    max_attempts: int = 8
+    base_delay: float = 0.1
+    max_delay: float = 20.0
+    in_flight: int = 0
+    # Requests that wait for a slot.
+    waiting: int = 0
+    last_decrease: float = 0.0
+    stats: Dict[str, Stats] = field(default_factory=dict)
+    condition: threading.Condition = field(
+        default_factory=threading.Condition, repr=False
+    )
+
+    def call(self, operation: str, request: Callable[[], T]) -> T:
+        """
+        Run `request` once a slot is free, retrying it when it fails
+        with an error that may go away.
+        """
+        with self.condition:
+            stats = self.stats.setdefault(operation, Stats())
+            stats.calls += 1
+
+        for attempt in range(self.max_attempts):
+            started = self.acquire()
+            try:
+                result = request()
+            except Exception as error:
+                outcome = classify(error)
+                self.release(started, outcome)
+
+                with self.condition:
+                    if outcome == Outcome.throttled:
+                        stats.throttled += 1
+                    if outcome == Outcome.fatal or attempt + 1 == self.max_attempts:
+                        stats.failed += 1
+                        raise
+                    stats.retries += 1
+
+                time.sleep(self.backoff(attempt))
+            except BaseException:
+                # Like Ctrl-C. Give the slot back, or it would be taken for
+                # good, but this says nothing about the service.
+                self.release(started, Outcome.fatal)
+                raise
+            else:
+                latency = time.monotonic() - started
+                self.release(started, None)
+                with self.condition:
+                    stats.latencies.append(latency)
+                return result
+
+        raise AssertionError("unreachable")
+
+    def acquire(self) -> float:
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.waiting += 1
+                self.condition.wait()
+                self.waiting -= 1
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started: float, outcome: Optional[Outcome]) -> None:
+        with self.condition:
+            limited = self.waiting > 0 or self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if outcome is None and limited:
+                # Until the first throttled request, grow the limit quickly.
+                increase = 1.0 if self.last_decrease == 0.0 else 1 / self.limit
+                self.limit = min(self.max_limit, self.limit + increase)
+            elif outcome == Outcome.throttled and started > self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self.last_decrease = time.monotonic()
+            self.condition.notify_all()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (1 << attempt)))
+
+    def summary(self) -> List[str]:
+        with self.condition:
+            return [
+                f"{operation}: {stats.summary()}"
+                for operation, stats in sorted(self.stats.items())
+            ]
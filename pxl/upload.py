@@ -1,27 +1,34 @@
 from __future__ import annotations
 
 import boto3  # type: ignore
+import botocore.config  # type: ignore
 import datetime
 import getpass
 import json
 import socket
 import sys
+import tempfile
 import uuid
 
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Dict, Iterator, Union, Optional
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union, Optional
 
 import pxl.config as config
 import pxl.compress as compress
+import pxl.exif as exif
+import pxl.journal as journal
 import pxl.state as state
+import pxl.throttle as throttle
 
 
 @dataclass
 class Client:
     boto: Any  # Boto is bad at typing.
     cfg: config.Config
+    # Every request to the bucket goes through the controller.
+    controller: throttle.Controller = field(default_factory=throttle.Controller)
 
 
 @dataclass
@@ -63,14 +70,25 @@ def client(cfg: config.Config, *, break_lock: bool = False) -> Iterator[Client]:
         aws_access_key_id=cfg.s3_key_id,
         aws_secret_access_key=cfg.s3_key_secret,
         endpoint_url=endpoint_url,
+        # Retries are up to the controller, which needs to see throttled
+        # requests to adapt to them.
+        config=botocore.config.Config(retries={"max_attempts": 0}),
     )
+    controller = throttle.Controller()
 
     placed_lock = False
     try:
-        resp = boto.list_objects_v2(Prefix="lock.json", Bucket=cfg.s3_bucket)
+        resp = controller.call(
+            "list",
+            lambda: boto.list_objects_v2(Prefix="lock.json", Bucket=cfg.s3_bucket),
+        )
         for obj in resp.get("Contents", []):
-            object_data = boto.get_object(Key="lock.json", Bucket=cfg.s3_bucket)
-            lock_json = json.load(object_data["Body"])
+            lock_json = controller.call(
+                "get",
+                lambda: json.load(
+                    boto.get_object(Key="lock.json", Bucket=cfg.s3_bucket)["Body"]
+                ),
+            )
             existing_lock = Lock.from_json(lock_json)
 
             lock_info = f"{existing_lock.user}@{existing_lock.hostname} on {existing_lock.start_time}"
@@ -85,35 +103,94 @@ def client(cfg: config.Config, *, break_lock: bool = False) -> Iterator[Client]:
             else:
                 print(f"Breaking a lock set by {lock_info}.")
 
-        boto.put_object(
-            Body=json.dumps(Lock.new().to_json()),
-            Bucket=cfg.s3_bucket,
-            ContentType="application/json",
-            Key="lock.json",
+        lock_body = json.dumps(Lock.new().to_json())
+        controller.call(
+            "put",
+            lambda: boto.put_object(
+                Body=lock_body,
+                Bucket=cfg.s3_bucket,
+                ContentType="application/json",
+                Key="lock.json",
+            ),
         )
         placed_lock = True
 
-        yield Client(boto=boto, cfg=cfg)
+        yield Client(boto=boto, cfg=cfg, controller=controller)
 
     finally:
         if placed_lock:
-            boto.delete_objects(
-                Delete={"Objects": [{"Key": "lock.json"}]}, Bucket=cfg.s3_bucket
+            controller.call(
+                "delete",
+                lambda: boto.delete_objects(
+                    Delete={"Objects": [{"Key": "lock.json"}]}, Bucket=cfg.s3_bucket
+                ),
             )
 
 
-def public_image_with_size(client: Client, local_filename: Path) -> state.Image:
-    file_uuid = uuid.uuid4()
+def public_image_with_size(
+    client: Client,
+    local_filename: Path,
+    upload_journal: Optional[journal.Journal] = None,
+    check: Optional[Callable[[state.Image], bool]] = None,
+    header: Optional[exif.Header] = None,
+) -> Optional[state.Image]:
+    """
+    Compress and upload a local image in all sizes.
+
+    With a journal, every step is recorded in it. When the journal shows
+    that the image was already (partially) uploaded before, its UUID is
+    reused and only the missing sizes are uploaded.
+
+    The `check` is called after compressing and before uploading. When it
+    returns False, the image is not uploaded and this returns None.
+
+    Pass the `header` when it was read already, to save reading it again.
+    """
+    entry = upload_journal.get(local_filename) if upload_journal else None
+    if entry and entry.is_uploaded():
+        return entry.image
+
+    file_uuid = entry.image.remote_uuid if entry else uuid.uuid4()
     extension = get_normalized_extension(local_filename)
+    if header is None:
+        header = exif.read_header(local_filename)
+
+    with tempfile.TemporaryDirectory(prefix="pxl-") as tempdir:
+        compressed = compress.compress_image(
+            local_filename,
+            Path(tempdir),
+            compress.profiles_from_json(client.cfg.encoding_profiles),
+        )
+        image = (
+            entry.image
+            if entry
+            else state.Image(
+                remote_uuid=file_uuid,
+                available_sizes=list(compressed.paths.keys()),
+                aliases=compressed.aliases,
+                dhash=compressed.dhash,
+                width=compressed.width,
+                height=compressed.height,
+                captured=header.captured,
+                camera=header.camera,
+            )
+        )
+        if not entry and check and not check(image):
+            return None
 
-    local_scaled_files = compress.compress_image(local_filename)
-    for size, local_filename in local_scaled_files.items():
-        object_name = f"{file_uuid}{size.path_suffix}{extension}"
-        public_image(client, local_filename, object_name)
+        if upload_journal and not entry:
+            upload_journal.processed(local_filename, image)
 
-    return state.Image(
-        remote_uuid=file_uuid, available_sizes=list(local_scaled_files.keys())
-    )
+        for size, local_scaled_file in compressed.paths.items():
+            if size in image.aliases or (entry and size in entry.uploaded):
+                continue
+
+            object_name = f"{file_uuid}{size.path_suffix}{extension}"
+            public_image(client, local_scaled_file, object_name)
+            if upload_journal:
+                upload_journal.uploaded(local_filename, size)
+
+    return image
 
 
 def public_image(client: Client, local_filename: Path, object_name: str) -> None:
@@ -127,29 +204,135 @@ def public_image(client: Client, local_filename: Path, object_name: str) -> None
         "ContentDisposition": "attachment",
         "CacheControl": "must-revalidate",
     }
-    client.boto.upload_file(
-        Filename=str(local_filename),
-        Bucket=client.cfg.s3_bucket,
-        ExtraArgs=extra_args,
-        Key=object_name,
+    client.controller.call(
+        "upload",
+        lambda: client.boto.upload_file(
+            Filename=str(local_filename),
+            Bucket=client.cfg.s3_bucket,
+            ExtraArgs=extra_args,
+            Key=object_name,
+        ),
+    )
+
+
+def public_bytes(
+    client: Client,
+    data: bytes,
+    object_name: str,
+    immutable: bool = False,
+    attachment: bool = False,
+) -> None:
+    """
+    Upload an image that we made ourselves as world readable.
+
+    Pass `immutable` when the object under this name never changes, so
+    browsers don't have to check whether it did. Pass `attachment` for
+    the sizes of an image, which `public_image` uploads like that too.
+    """
+    extra_args = {"ContentDisposition": "attachment"} if attachment else {}
+    client.controller.call(
+        "put",
+        lambda: client.boto.put_object(
+            Body=data,
+            Bucket=client.cfg.s3_bucket,
+            ContentType="image/jpeg",
+            ACL="public-read",
+            CacheControl=(
+                "public, max-age=31536000, immutable"
+                if immutable
+                else "must-revalidate"
+            ),
+            Key=object_name,
+            **extra_args,
+        ),
     )
 
 
 def get_json(client: Client, object_name: str) -> Any:
-    resp = client.boto.get_object(Bucket=client.cfg.s3_bucket, Key=object_name)
-    contents = resp["Body"].read()
-    return json.loads(contents)
+    return json.loads(get_bytes(client, object_name))
+
+
+def get_bytes(client: Client, object_name: str) -> bytes:
+    def get() -> bytes:
+        # The connection can break while reading the body, so reading it
+        # is part of the request that is retried.
+        resp = client.boto.get_object(Bucket=client.cfg.s3_bucket, Key=object_name)
+        contents: bytes = resp["Body"].read()
+        return contents
+
+    return client.controller.call("get", get)
+
+
+def get_etag(client: Client, object_name: str) -> Optional[str]:
+    """
+    The ETag of an object, or None when there is no such object. For
+    objects that were not uploaded in parts, it is the MD5 of the bytes.
+    """
+    try:
+        resp = client.controller.call(
+            "head",
+            lambda: client.boto.head_object(
+                Bucket=client.cfg.s3_bucket, Key=object_name
+            ),
+        )
+    except client.boto.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey"]:
+            return None
+        raise
+
+    etag: str = resp["ETag"].strip('"')
+    return etag
+
+
+def list_object_names(client: Client) -> List[str]:
+    """
+    The names of all objects in the bucket.
+    """
+    names: List[str] = []
+    kwargs = {"Bucket": client.cfg.s3_bucket}
+    while True:
+        resp = client.controller.call(
+            "list", lambda: client.boto.list_objects_v2(**kwargs)
+        )
+        names.extend(obj["Key"] for obj in resp.get("Contents", []))
+        if not resp.get("IsTruncated"):
+            return names
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+
+def get_range(
+    client: Client, object_name: str, start: int, end: int
+) -> Tuple[bytes, int]:
+    """
+    Get bytes `start` up to and including `end` of an object. Returns
+    them with the size of the whole object.
+    """
+
+    def get() -> Tuple[bytes, int]:
+        resp = client.boto.get_object(
+            Bucket=client.cfg.s3_bucket, Key=object_name, Range=f"bytes={start}-{end}"
+        )
+        contents: bytes = resp["Body"].read()
+        # Like "bytes 0-1023/4096". Without it, we got the whole object.
+        content_range = resp.get("ContentRange")
+        size = int(content_range.rsplit("/", 1)[1]) if content_range else len(contents)
+        return contents, size
+
+    return client.controller.call("get", get)
 
 
 def private_json(client: Client, contents: str, object_name: str) -> None:
     """
     Upload a local JSON file as private under a given name.
     """
-    client.boto.put_object(
-        Body=contents,
-        Bucket=client.cfg.s3_bucket,
-        ContentType="application/json",
-        Key=object_name,
+    client.controller.call(
+        "put",
+        lambda: client.boto.put_object(
+            Body=contents,
+            Bucket=client.cfg.s3_bucket,
+            ContentType="application/json",
+            Key=object_name,
+        ),
     )
 
 
@@ -166,7 +349,14 @@ def delete_image(client: Client, filename: str) -> None:
     """
     Delete an image from the photo hosting.
     """
-    client.boto.delete_objects(
-        Delete={"Objects": [{"Key": filename + ".jpg"}]}, Bucket=client.cfg.s3_bucket
-    )
+    delete_object(client, filename + ".jpg")
     print("deleted " + filename + ".jpg")
+
+
+def delete_object(client: Client, object_name: str) -> None:
+    client.controller.call(
+        "delete",
+        lambda: client.boto.delete_objects(
+            Delete={"Objects": [{"Key": object_name}]}, Bucket=client.cfg.s3_bucket
+        ),
+    )
@@ -0,0 +1,71 @@
+import time
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Set, Tuple
+
+JPEG_SUFFIXES = [".jpeg", ".jpg"]
+
+# JPEG files end with an End Of Image marker. Some cameras pad the file
+# with a few trailing bytes, so we look for the marker near the end
+# instead of at the exact last two bytes.
+JPEG_EOI = b"\xff\xd9"
+JPEG_TAIL_SIZE = 1024
+
+
+def is_jpeg(entry: Path) -> bool:
+    return entry.is_file() and entry.suffix.lower() in JPEG_SUFFIXES
+
+
+def is_complete(entry: Path) -> bool:
+    """
+    Check whether a JPEG file has been written completely.
+
+    Tethering software and card readers write files in chunks, so a file
+    that exists is not necessarily a file we can read. A finished JPEG
+    file ends with an End Of Image marker.
+    """
+    try:
+        with entry.open("rb") as f:
+            size = f.seek(0, 2)
+            f.seek(max(0, size - JPEG_TAIL_SIZE))
+            return JPEG_EOI in f.read()
+    except OSError:
+        return False
+
+
+def poll(dir_path: Path, seen: Set[Path], interval: float) -> Iterator[List[Path]]:
+    """
+    Follow a directory and yield batches of new, completely written JPEGs.
+
+    A file is only yielded once its size and modification time did not
+    change between two polls and it ends with an End Of Image marker.
+    Every yielded file is added to `seen`, so it is never yielded twice.
+    This yields once every `interval` seconds, also when the batch is
+    empty, so the caller gets a chance to do periodic work. This never
+    returns; stop it with a KeyboardInterrupt.
+    """
+    pending: Dict[Path, Tuple[int, int]] = {}
+
+    while True:
+        batch = []
+        for entry in sorted(dir_path.iterdir()):
+            if entry in seen or not is_jpeg(entry):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Renamed or removed while we were looking.
+                pending.pop(entry, None)
+                continue
+
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if pending.get(entry) == signature and is_complete(entry):
+                del pending[entry]
+                seen.add(entry)
+                batch.append(entry)
+            else:
+                pending[entry] = signature
+
+        yield batch
+        time.sleep(interval)
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Tuple,
+    TypeVar,
+)
+
+# Helpers for commands that work through many files and can be resumed:
+# a log of the work that is done, and a pool that works ahead on a few
+# items at a time.
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class Log:
+    """
+    A local file of JSON records, that grows by a line for every record.
+
+    With `sync`, every record is synced to disk before `append` returns,
+    so a record that was written outlives a crash of the machine. Without
+    it, the last records can get lost, which is fine when that only means
+    doing some work again.
+    """
+
+    path: Path
+    sync: bool = True
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def read(self) -> List[Dict[str, Any]]:
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return []
+
+        records = []
+        end = 0
+        for line in data.splitlines(keepends=True):
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("line without end")
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            end += len(line)
+
+        if end < len(data):
+            # The last line is torn when we crashed while writing it. It
+            # is cut off, so that the records we append after it are not
+            # appended to it.
+            with self.path.open("r+b") as f:
+                f.truncate(end)
+
+        return records
+
+    def append(self, record: Dict[str, Any]) -> None:
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+                if self.sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def clear(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text("")
+
+    def remove(self) -> None:
+        if self.path.exists():
+            self.path.unlink()
+
+
+def in_order(
+    function: Callable[[T], R], items: Iterable[T], jobs: int
+) -> Generator[Tuple[T, concurrent.futures.Future[R]], None, None]:
+    """
+    Run `function` on `items` in a pool of `jobs` threads, and yield the
+    items with their futures in order.
+
+    Only a few items per job are taken from `items` ahead of the one we
+    wait for, so memory stays bounded no matter how many there are. Use
+    it with `contextlib.closing`, so that items nobody will wait for are
+    cancelled when the caller stops early.
+    """
+    todo = iter(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending: Deque[Tuple[T, concurrent.futures.Future[R]]] = collections.deque()
+
+        def fill() -> None:
+            while len(pending) < 2 * jobs:
+                item = next(todo, None)
+                if item is None:
+                    return
+                pending.append((item, executor.submit(function, item)))
+
+        try:
+            fill()
+            while pending:
+                yield pending.popleft()
+                fill()
+        finally:
+            for _, future in pending:
+                future.cancel()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Measure how long pxl takes to start for commands that don't need S3,
+Pillow or Jinja, and check that those libraries are not imported.
+
+Exits with status 1 when a command imports one of those libraries, so this
+can guard against regressions in CI. How long a command takes depends on
+the machine, so the timings are only a report, aimed at 100 ms. They fail
+the run only with an explicit `--target-ms`.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import List, Optional
+
+MAIN = Path(__file__).parent.parent.absolute() / "main.py"
+
+# Commands that should start without loading the heavy dependencies.
+# `preview` exits right away because there is no build output in the
+# temporary directory we run it in.
+COMMANDS = [["--help"], ["upload", "--help"], ["build", "--help"], ["preview"]]
+
+HEAVY_MODULES = ["boto3", "botocore", "PIL", "jinja2", "dateutil"]
+
+
+def run(args: List[str], cwd: str) -> None:
+    subprocess.run(
+        [sys.executable, str(MAIN)] + args,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def imported_heavy_modules(args: List[str], cwd: str) -> List[str]:
+    # With -X importtime, Python prints every imported module to stderr,
+    # as the last column of a table.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(MAIN)] + args,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    modules = {
+        line.rsplit("|", 1)[-1].strip().split(".")[0]
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return [module for module in HEAVY_MODULES if module in modules]
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--runs", type=int, default=10)
+    arg_parser.add_argument("--target-ms", type=float)
+    opts = arg_parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        for args in COMMANDS:
+            name = " ".join(["pxl"] + args)
+
+            heavy = imported_heavy_modules(args, cwd)
+            if heavy:
+                print(f"FAIL {name} imports {', '.join(heavy)}")
+                failed = True
+
+            timings = []
+            for _ in range(opts.runs):
+                start = time.perf_counter()
+                run(args, cwd)
+                timings.append((time.perf_counter() - start) * 1000)
+
+            # Like timeit, we compare the fastest run with the target.
+            # Slower runs are slower because of other processes, not pxl.
+            best = min(timings)
+            median = statistics.median(timings)
+            target: Optional[float] = opts.target_ms
+            if target is None:
+                print(f"     {name}: best {best:.0f} ms, median {median:.0f} ms")
+            else:
+                status = "ok  " if best <= target else "FAIL"
+                print(
+                    f"{status} {name}: best {best:.0f} ms, median {median:.0f} ms"
+                    f" (target {target:.0f} ms)"
+                )
+                failed = failed or best > target
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
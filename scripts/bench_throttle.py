@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Compare upload throughput at fixed concurrencies with the adaptive
+controller, against a local stand-in for a bucket that throttles.
+
+The stand-in serves `--capacity` requests at a time, each taking
+`--latency` seconds. Requests beyond its capacity are answered with
+503 SlowDown, like Spaces does, after a short delay. Uploads go through
+`upload.public_image`, and the stand-in raises errors the way boto3's
+`upload_file` does.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import sys
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+import boto3.exceptions  # type: ignore
+import botocore.exceptions  # type: ignore
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+import pxl.config as config  # noqa: E402
+import pxl.throttle as throttle  # noqa: E402
+import pxl.upload as upload  # noqa: E402
+
+
+class StandIn:
+    def __init__(self, capacity: int, latency: float) -> None:
+        self.capacity = capacity
+        self.latency = latency
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def upload_file(
+        self, Filename: str, Bucket: str, Key: str, **kwargs: object
+    ) -> None:
+        # Like boto3, which wraps every ClientError of an upload.
+        try:
+            self.put_object()
+        except botocore.exceptions.ClientError as e:
+            raise boto3.exceptions.S3UploadFailedError(
+                f"Failed to upload {Filename} to {Bucket}/{Key}: {e}"
+            )
+
+    def put_object(self) -> None:
+        with self.lock:
+            accepted = self.in_flight < self.capacity
+            if accepted:
+                self.in_flight += 1
+
+        if not accepted:
+            time.sleep(self.latency / 10)
+            raise botocore.exceptions.ClientError(
+                {
+                    "Error": {"Code": "SlowDown", "Message": "Please reduce your rate"},
+                    "ResponseMetadata": {"HTTPStatusCode": 503},
+                },
+                "PutObject",
+            )
+
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+
+
+def run(
+    controller: throttle.Controller, stand_in: StandIn, requests: int, workers: int
+) -> None:
+    cfg = config.Config(
+        s3_endpoint="bench",
+        s3_region="bench",
+        s3_bucket="bench",
+        s3_key_id="bench",
+        s3_key_secret="bench",
+        deploy_host="bench",
+        deploy_user="bench",
+        deploy_path="bench",
+        public_image_url="bench",
+    )
+    client = upload.Client(boto=stand_in, cfg=cfg, controller=controller)
+
+    with tempfile.NamedTemporaryFile(suffix=".jpg") as f, contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    upload.public_image, client, Path(f.name), f"bench-{i}.jpg"
+                )
+                for i in range(requests)
+            ]
+            # Failed requests are counted in the statistics.
+            concurrent.futures.wait(futures)
+        seconds = time.perf_counter() - start
+
+    best = stand_in.capacity / stand_in.latency
+    print(
+        f"  {requests / seconds:6.1f} requests/s ({requests / seconds / best:.0%} of"
+        f" {best:.0f}), final limit {controller.limit:.1f}"
+    )
+    for line in controller.summary():
+        print(f"  {line}")
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--capacity", type=int, default=12)
+    arg_parser.add_argument("--latency", type=float, default=0.05)
+    arg_parser.add_argument("--requests", type=int, default=1000)
+    arg_parser.add_argument("--workers", type=int, default=64)
+    opts = arg_parser.parse_args()
+
+    fixed = [2, opts.capacity, opts.workers]
+    for limit in fixed:
+        print(f"Fixed concurrency {limit}:")
+        controller = throttle.Controller(
+            limit=limit, min_limit=limit, max_limit=limit, base_delay=opts.latency
+        )
+        run(controller, StandIn(opts.capacity, opts.latency), opts.requests, limit)
+
+    print("Adaptive:")
+    controller = throttle.Controller(base_delay=opts.latency)
+    run(
+        controller,
+        StandIn(opts.capacity, opts.latency),
+        opts.requests,
+        opts.workers,
+    )
+
+    # A caller that runs few requests at once keeps the limit near its
+    # own concurrency, instead of letting it climb to the maximum.
+    print("Adaptive, with 4 workers:")
+    controller = throttle.Controller(base_delay=opts.latency)
+    run(controller, StandIn(opts.capacity, opts.latency), opts.requests, 4)
+
+
+if __name__ == "__main__":
+    main()